@@ -1,46 +1,64 @@
 # ai/azure_openai_validator.py
-from openai import AzureOpenAI
+import asyncio
+import functools
+import re
+import time
+from collections import deque
+import httpx
+import numpy as np
+from openai import AsyncAzureOpenAI, APIStatusError
 from typing import Dict, List, Optional
-import json
+import orjson
 import structlog
-from tenacity import retry, stop_after_attempt, wait_exponential
-from pydantic import BaseModel, Field, field_validator
+
+try:
+    from fastembed import TextEmbedding
+except ImportError:
+    TextEmbedding = None
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
 
 from config import settings
 
 logger = structlog.get_logger()
 
+# Soglie business hoistate a costanti di modulo: evitano l'accesso
+# con overhead descrittore di BaseSettings per ogni fattura del batch
+_AUTO_APPROVE_THRESHOLD = settings.AUTO_APPROVE_THRESHOLD
+_MAX_INVOICE_AMOUNT = settings.MAX_INVOICE_AMOUNT
+_OCR_CONFIDENCE_THRESHOLD = settings.OCR_CONFIDENCE_THRESHOLD
+
 class InvoiceData(BaseModel):
     """Modello Pydantic per dati fattura validati"""
-    
+
     invoice_number: str = Field(..., description="Numero fattura")
     invoice_date: str = Field(..., pattern=r'^\d{4}-\d{2}-\d{2}$')
-    
+
     supplier_name: str
     supplier_vat: str = Field(..., pattern=r'^\d{11}$')
     supplier_address: Optional[str] = None
-    
+
     customer_name: str
     customer_vat: str = Field(..., pattern=r'^\d{11}$')
     customer_address: Optional[str] = None
-    
+
     subtotal: float = Field(..., gt=0)
     vat_rate: float = Field(default=0.22, ge=0, le=1)
     vat_amount: float = Field(..., ge=0)
     total_amount: float = Field(..., gt=0)
-    
+
     line_items: List[Dict] = Field(default_factory=list)
     payment_terms: Optional[str] = None
     due_date: Optional[str] = None
-    
+
     currency: str = Field(default="EUR", pattern=r'^[A-Z]{3}$')
-    
+
     # Metadati validazione
     ocr_confidence: float = Field(..., ge=0, le=100)
     ai_validation_score: float = Field(..., ge=0, le=1)
     validation_notes: List[str] = Field(default_factory=list)
     requires_manual_review: bool = False
-    
+
     @field_validator('total_amount')
     @classmethod
     def validate_total(cls, v: float, info) -> float:
@@ -52,7 +70,7 @@ class InvoiceData(BaseModel):
                     f"Total {v} doesn't match subtotal + VAT {expected_total}"
                 )
         return v
-    
+
     @field_validator('vat_amount')
     @classmethod
     def validate_vat(cls, v: float, info) -> float:
@@ -65,25 +83,289 @@ class InvoiceData(BaseModel):
                 )
         return v
 
+# Validator pre-costruito a import time: TypeAdapter evita il lookup
+# dello schema che BaseModel.model_validate paga ad ogni chiamata e
+# anticipa il costo di build dello schema fuori dal percorso caldo
+_INVOICE_ADAPTER = TypeAdapter(InvoiceData)
+
+# Fence markdown che il modello a volte aggiunge attorno al JSON
+_FENCE_OPEN_RE = re.compile(r'^\s*```(?:json)?\s*\n?')
+_FENCE_CLOSE_RE = re.compile(r'\n?```\s*$')
+
+def _robust_json_parse(text: str) -> Dict:
+    """
+    Parse tollerante della risposta del modello
+
+    Prima rimuove eventuali fence markdown e prova il parse diretto;
+    in fallback estrae il primo oggetto JSON bilanciando le graffe.
+    Evita di pagare un retry tenacity (una chiamata API intera) per
+    semplice prosa o fence attorno a un JSON valido.
+    """
+    stripped = _FENCE_CLOSE_RE.sub('', _FENCE_OPEN_RE.sub('', text))
+
+    try:
+        return orjson.loads(stripped)
+    except orjson.JSONDecodeError:
+        pass
+
+    # Fallback: estrai il blocco { ... } bilanciato
+    start = stripped.find('{')
+    if start >= 0:
+        depth = 0
+        in_string = False
+        escape = False
+        for i in range(start, len(stripped)):
+            ch = stripped[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif ch == '\\':
+                    escape = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    return orjson.loads(stripped[start:i + 1])
+
+    # Nessun JSON recuperabile: lascia che tenacity ritenti
+    raise ValueError(f"Risposta AI non contiene JSON valido: {text[:200]!r}")
+
+def _as_float(value) -> float:
+    """Coercizione difensiva a float per i numeri del modello
+
+    Il JSON della risposta arriva qui prima della validazione Pydantic:
+    un importo può legittimamente essere la stringa "1234.56" (o null),
+    e un confronto diretto con le soglie solleverebbe TypeError — che
+    dentro _validate_once costerebbe tre chiamate API di retry.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+@functools.lru_cache(maxsize=8192)
+def valid_piva(piva: str) -> bool:
+    """
+    Checksum locale della Partita IVA italiana (algoritmo Luhn-like)
+
+    Somma le cifre in posizione dispari più le cifre pari raddoppiate
+    (con cap a 9); l'undicesima cifra è il check digit. Validare qui
+    evita di spendere token GPT-4 per un controllo aritmetico.
+    """
+    if len(piva) != 11 or not piva.isdigit():
+        return False
+
+    total = 0
+    for i in range(10):
+        digit = ord(piva[i]) - 48
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+
+    return (10 - total % 10) % 10 == ord(piva[10]) - 48
+
+class AzureRateLimiter:
+    """
+    Token bucket proattivo per i limiti RPM/TPM di Azure OpenAI
+
+    Tenacity reagisce solo dopo un 429; questo limiter ritarda la
+    sottomissione quando il budget della finestra mobile di 60s non
+    basta, evitando richieste sprecate e le sleep di penalità.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self._rpm = rpm
+        self._tpm = tpm
+        self._lock = asyncio.Lock()
+        self._requests = deque()  # timestamp delle richieste
+        self._tokens = deque()    # (timestamp, token stimati)
+        self._token_total = 0
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        """Blocca finché non c'è budget per una richiesta"""
+        # Una stima oltre l'intero budget TPM (testo OCR enorme, o TPM
+        # configurato sotto la riserva fissa di completion) non verrebbe
+        # ammessa mai: cap alla finestra, così la richiesta parte appena
+        # il budget è libero e al peggio degrada in un 429 gestito dai
+        # retry invece di un hang silenzioso
+        estimated_tokens = min(estimated_tokens, self._tpm)
+
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                self._evict(now)
+
+                if (len(self._requests) < self._rpm
+                        and self._token_total + estimated_tokens <= self._tpm):
+                    self._requests.append(now)
+                    self._tokens.append((now, estimated_tokens))
+                    self._token_total += estimated_tokens
+                    return
+
+                # Attendi che l'entry più vecchia esca dalla finestra
+                oldest = self._requests[0] if self._requests else now
+                if self._tokens:
+                    oldest = min(oldest, self._tokens[0][0])
+                wait = max(oldest + 60.0 - now, 0.1)
+
+            await asyncio.sleep(wait)
+
+    def reset_loop(self) -> None:
+        """Ricrea il lock quando l'entry point cambia event loop
+
+        La finestra mobile (richieste e token) resta intatta: è il
+        lock asyncio a essere legato al loop, non il budget.
+        """
+        self._lock = asyncio.Lock()
+
+    def _evict(self, now: float) -> None:
+        cutoff = now - 60.0
+        while self._requests and self._requests[0] < cutoff:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] < cutoff:
+            _, used = self._tokens.popleft()
+            self._token_total -= used
+
+    def update_from_headers(self, headers) -> None:
+        """
+        Riallinea il budget con gli header x-ratelimit-remaining-*
+
+        Il valore lato server è la verità: se è più basso di quanto
+        stimato localmente, inserisce un'entry sintetica che satura la
+        differenza per il resto della finestra.
+        """
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        if remaining_tokens is not None:
+            try:
+                remaining = int(remaining_tokens)
+            except ValueError:
+                return
+            now = time.monotonic()
+            local_remaining = self._tpm - self._token_total
+            if remaining < local_remaining:
+                gap = local_remaining - remaining
+                self._tokens.append((now, gap))
+                self._token_total += gap
+
 class AzureOpenAIValidator:
     """Validatore AI per dati fattura estratti via OCR"""
-    
-    def __init__(self):
+
+    def __init__(self, max_concurrency: int = 10):
         self.logger = logger.bind(component="AIValidator")
-        
-        self.client = AzureOpenAI(
-            api_key=settings.AZURE_OPENAI_KEY,
+
+        # Client e primitive asyncio creati pigramente nel loop che li
+        # usa (vedi _ensure_clients): gli entry point sincroni aprono
+        # ciascuno il proprio loop con asyncio.run, e le connessioni
+        # keep-alive di httpx — come Semaphore e Lock — restano legate
+        # al loop di creazione; riusarle dal loop successivo solleva
+        # "Event loop is closed" dentro httpcore
+        self.client = None
+        self._primary = None
+        self._fallback = None
+        self._client_loop = None
+        self._client_failures = {}
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+
+        self.deployment = settings.AZURE_OPENAI_DEPLOYMENT
+
+        # System prompt costruito una volta sola: oltre al risparmio di
+        # CPU, un prefisso byte-identico è il requisito per gli hit del
+        # prompt caching lato server
+        self._system_prompt = self._create_validation_prompt()
+
+        # Budget RPM/TPM condiviso tra tutte le chiamate del processo
+        self._limiter = AzureRateLimiter(
+            rpm=settings.AZURE_OPENAI_RPM,
+            tpm=settings.AZURE_OPENAI_TPM
+        )
+
+        # Embedding locale per il similarity check: ordini di grandezza
+        # più economico di una completion GPT-4; se il modello non è
+        # disponibile resta il fallback LLM
+        self._embedder = None
+        if TextEmbedding is not None:
+            try:
+                self._embedder = TextEmbedding('BAAI/bge-small-en-v1.5')
+            except Exception as e:
+                self.logger.warning(
+                    "Modello embedding locale non disponibile",
+                    error=str(e)
+                )
+
+    @staticmethod
+    def _build_client(endpoint: str, api_key: str) -> AsyncAzureOpenAI:
+        """Client con pool keep-alive HTTP/2, legato al loop corrente
+
+        Il keep-alive evita handshake TLS a freddo sotto il pattern
+        bursty dello scheduler; HTTP/2 multiplexa le chiamate
+        concorrenti su una sola connessione.
+        """
+        return AsyncAzureOpenAI(
+            api_key=api_key,
             api_version=settings.AZURE_OPENAI_API_VERSION,
-            azure_endpoint=settings.AZURE_OPENAI_ENDPOINT
+            azure_endpoint=endpoint,
+            max_retries=0,  # i retry li governa solo tenacity
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=32,
+                    max_keepalive_connections=32
+                ),
+                http2=True,
+                timeout=60.0
+            )
         )
-        
-        self.deployment = settings.AZURE_OPENAI_DEPLOYMENT
-    
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=2, max=10)
-    )
-    def validate_and_structure_invoice(
+
+    def _ensure_clients(self) -> None:
+        """(Ri)crea client e primitive asyncio per il loop corrente
+
+        Al primo uso, o quando l'entry point sincrono ha aperto un
+        nuovo loop con asyncio.run, i client del loop precedente non
+        sono più usabili: vengono abbandonati al GC (le connessioni
+        appartengono a un loop ormai chiuso) e ricostruiti qui. Lo
+        stato della finestra del rate limiter sopravvive: il budget è
+        per processo, non per loop.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is self._client_loop:
+            return
+
+        on_fallback = self.client is not None and self.client is self._fallback
+
+        self._primary = self._build_client(
+            settings.AZURE_OPENAI_ENDPOINT,
+            settings.AZURE_OPENAI_KEY
+        )
+
+        # Rail secondario: quando il primario risponde 429/5xx la
+        # chiamata successiva va sull'endpoint di fallback
+        self._fallback = None
+        if settings.AZURE_OPENAI_FALLBACK_ENDPOINT:
+            self._fallback = self._build_client(
+                settings.AZURE_OPENAI_FALLBACK_ENDPOINT,
+                settings.AZURE_OPENAI_FALLBACK_KEY
+            )
+
+        # Mantieni il lato scelto da _rotate_client prima del rebind
+        if on_fallback and self._fallback is not None:
+            self.client = self._fallback
+        else:
+            self.client = self._primary
+            self.deployment = settings.AZURE_OPENAI_DEPLOYMENT
+
+        # Limita le chiamate concorrenti verso Azure OpenAI
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._limiter.reset_loop()
+        self._client_loop = loop
+
+    async def validate_and_structure_invoice(
         self,
         ocr_text: str,
         extracted_fields: Dict,
@@ -91,26 +373,86 @@ class AzureOpenAIValidator:
     ) -> InvoiceData:
         """
         Valida e struttura dati fattura usando Azure OpenAI
-        
+
         Args:
             ocr_text: Testo completo estratto da OCR
             extracted_fields: Campi estratti via regex
             ocr_confidence: Confidence media OCR
-            
+
         Returns:
             InvoiceData validato e strutturato
         """
+        self._ensure_clients()
+
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(3),
+            wait=wait_exponential(multiplier=1, min=2, max=10),
+            reraise=True
+        ):
+            with attempt:
+                try:
+                    return await self._validate_once(
+                        ocr_text, extracted_fields, ocr_confidence
+                    )
+                except APIStatusError as e:
+                    if e.status_code == 429 or e.status_code >= 500:
+                        self._rotate_client()
+                    raise
+
+    def _rotate_client(self) -> None:
+        """Passa al client gemello dopo un 429/5xx"""
+        now = time.monotonic()
+        self._client_failures[id(self.client)] = now
+
+        if self._fallback is None:
+            return
+
+        other = (
+            self._fallback if self.client is self._primary else self._primary
+        )
+
+        # Evita il ping-pong verso un lato fallito da poco
+        if now - self._client_failures.get(id(other), 0.0) < 30.0:
+            return
+
+        self.client = other
+        if other is self._fallback:
+            self.deployment = (
+                settings.AZURE_OPENAI_FALLBACK_DEPLOYMENT
+                or settings.AZURE_OPENAI_DEPLOYMENT
+            )
+        else:
+            self.deployment = settings.AZURE_OPENAI_DEPLOYMENT
+
+        self.logger.warning(
+            "Rotazione su endpoint AI secondario",
+            fallback=other is self._fallback
+        )
+
+    async def _validate_once(
+        self,
+        ocr_text: str,
+        extracted_fields: Dict,
+        ocr_confidence: float
+    ) -> InvoiceData:
+        """Singolo tentativo di validazione (wrappato da retry)"""
         self.logger.info("Inizio validazione AI")
-        
+
         # Prompt engineering per validazione
-        system_prompt = self._create_validation_prompt()
+        system_prompt = self._system_prompt
         user_message = self._format_extraction_data(
-            ocr_text, 
+            ocr_text,
             extracted_fields
         )
-        
-        # Chiamata Azure OpenAI
-        response = self.client.chat.completions.create(
+
+        # Stima grossolana: ~4 char per token di prompt + completion
+        await self._limiter.acquire(
+            estimated_tokens=(len(system_prompt) + len(user_message)) // 4 + 2000
+        )
+
+        # Chiamata Azure OpenAI in streaming: i token vengono accumulati
+        # man mano che arrivano invece di attendere la risposta completa
+        stream = await self.client.chat.completions.create(
             model=self.deployment,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -118,45 +460,92 @@ class AzureOpenAIValidator:
             ],
             temperature=0.1,  # Bassa per output deterministico
             max_tokens=2000,
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True},
+            extra_body={"prompt_cache_key": "invoice_validator_v1"}
         )
-        
+
+        buf = bytearray()
+        total_tokens = None
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                buf.extend(chunk.choices[0].delta.content.encode())
+            if chunk.usage is not None:
+                # L'ultimo chunk dello stream porta le usage stats
+                total_tokens = chunk.usage.total_tokens
+
         # Parse risposta
-        ai_response = response.choices[0].message.content
-        validated_data = json.loads(ai_response)
-        
+        validated_data = _robust_json_parse(buf.decode())
+
         self.logger.info(
             "Validazione AI completata",
-            tokens_used=response.usage.total_tokens
+            tokens_used=total_tokens
         )
-        
+
         # Aggiungi metadati
         validated_data['ocr_confidence'] = ocr_confidence
         validated_data['ai_validation_score'] = validated_data.get(
             'confidence_score', 0.9
         )
-        
+
+        # Business rules sul dict grezzo, prima della validazione: così
+        # il modello viene validato una volta sola, senza ri-assegnare
+        # campi su un'istanza Pydantic già costruita
+        validated_data = self._apply_business_rules(validated_data)
+
+        # Checksum P.IVA verificato localmente, senza spendere token
+        extracted_vat = extracted_fields.get('vat_number')
+        if extracted_vat and not valid_piva(str(extracted_vat)):
+            validated_data['requires_manual_review'] = True
+            validated_data['validation_notes'].append(
+                f"Checksum P.IVA non valido: {extracted_vat}"
+            )
+
         # Validazione con Pydantic
         try:
-            invoice_data = InvoiceData.model_validate(validated_data)
+            invoice_data = _INVOICE_ADAPTER.validate_python(validated_data)
         except Exception as e:
             self.logger.error("Validazione Pydantic fallita", error=str(e))
             # Flagga per revisione manuale
             validated_data['requires_manual_review'] = True
-            validated_data['validation_notes'] = [str(e)]
-            invoice_data = InvoiceData.model_validate(
+            validated_data['validation_notes'].append(str(e))
+            invoice_data = _INVOICE_ADAPTER.validate_python(
                 validated_data,
                 strict=False
             )
-        
-        # Business rules validation
-        invoice_data = self._apply_business_rules(invoice_data)
-        
+
         return invoice_data
-    
+
+    async def validate_batch(
+        self,
+        jobs: List[Dict]
+    ) -> List:
+        """
+        Valida un batch di fatture in parallelo (path real-time)
+
+        Args:
+            jobs: Lista di dict con chiavi ocr_text, extracted_fields,
+                  ocr_confidence (stessi argomenti di
+                  validate_and_structure_invoice)
+
+        Returns:
+            Lista di InvoiceData o Exception, nello stesso ordine dei jobs
+        """
+        self._ensure_clients()
+
+        async def _bounded(job: Dict):
+            async with self._semaphore:
+                return await self.validate_and_structure_invoice(**job)
+
+        return await asyncio.gather(
+            *(_bounded(job) for job in jobs),
+            return_exceptions=True
+        )
+
     def _create_validation_prompt(self) -> str:
         """Crea system prompt per validazione"""
-        
+
         return f"""Sei un esperto contabile specializzato nell'analisi e validazione di fatture italiane.
 
 Il tuo compito è:
@@ -220,77 +609,111 @@ IMPORTANTE:
 - Se dati sembrano errati ma non sei sicuro, segnala in validation_notes
 - Se confidence_score < 0.7, imposta requires_manual_review = true
 """
-    
+
     def _format_extraction_data(
-        self, 
-        ocr_text: str, 
+        self,
+        ocr_text: str,
         fields: Dict
     ) -> str:
         """Formatta dati per prompt"""
-        
+
         return f"""Valida questa fattura estratta via OCR.
 
 TESTO COMPLETO OCR:
 {ocr_text}
 
 CAMPI ESTRATTI AUTOMATICAMENTE:
-{json.dumps(fields, indent=2, ensure_ascii=False)}
+{orjson.dumps(fields, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()}
 
 Analizza il testo, valida i campi estratti, correggi eventuali errori e restituisci il JSON validato.
 """
-    
-    def _apply_business_rules(self, invoice: InvoiceData) -> InvoiceData:
-        """Applica regole business"""
-        
+
+    def _apply_business_rules(self, data: Dict) -> Dict:
+        """Applica regole business sul dict pre-validazione
+
+        Il dict è l'output grezzo del modello: i tipi non sono ancora
+        garantiti da Pydantic, quindi numeri e note vengono coercizzati
+        prima dei confronti.
+        """
+        notes = data.get('validation_notes')
+        if isinstance(notes, str):
+            notes = [notes]
+        elif not isinstance(notes, list):
+            notes = []
+        data['validation_notes'] = notes
+        requires_review = bool(data.get('requires_manual_review', False))
+
+        total_amount = _as_float(data.get('total_amount'))
+        ocr_confidence = _as_float(data.get('ocr_confidence'))
+        ai_validation_score = _as_float(data.get('ai_validation_score'))
+
         # Verifica soglia auto-approvazione
-        if invoice.total_amount > settings.AUTO_APPROVE_THRESHOLD:
-            invoice.requires_manual_review = True
-            invoice.validation_notes.append(
-                f"Importo €{invoice.total_amount:.2f} supera soglia auto-approvazione"
+        if total_amount > _AUTO_APPROVE_THRESHOLD:
+            requires_review = True
+            notes.append(
+                f"Importo €{total_amount:.2f} supera soglia auto-approvazione"
             )
-        
+
         # Verifica importo massimo
-        if invoice.total_amount > settings.MAX_INVOICE_AMOUNT:
-            invoice.requires_manual_review = True
-            invoice.validation_notes.append(
-                f"Importo €{invoice.total_amount:.2f} supera limite massimo"
+        if total_amount > _MAX_INVOICE_AMOUNT:
+            requires_review = True
+            notes.append(
+                f"Importo €{total_amount:.2f} supera limite massimo"
             )
-        
+
         # Verifica confidence OCR
-        if invoice.ocr_confidence < settings.OCR_CONFIDENCE_THRESHOLD:
-            invoice.requires_manual_review = True
-            invoice.validation_notes.append(
-                f"Confidence OCR bassa: {invoice.ocr_confidence:.1f}%"
+        if ocr_confidence < _OCR_CONFIDENCE_THRESHOLD:
+            requires_review = True
+            notes.append(
+                f"Confidence OCR bassa: {ocr_confidence:.1f}%"
             )
-        
+
         # Verifica confidence AI
-        if invoice.ai_validation_score < 0.7:
-            invoice.requires_manual_review = True
-            invoice.validation_notes.append(
-                f"Confidence AI bassa: {invoice.ai_validation_score:.2f}"
+        if ai_validation_score < 0.7:
+            requires_review = True
+            notes.append(
+                f"Confidence AI bassa: {ai_validation_score:.2f}"
             )
-        
-        return invoice
-    
-    def semantic_similarity_check(
+
+        data['requires_manual_review'] = requires_review
+
+        return data
+
+    async def semantic_similarity_check(
         self,
         ocr_text: str,
         validated_data: InvoiceData
     ) -> float:
         """Verifica coerenza semantica tra OCR e dati validati"""
-        
-        # Usa embedding per similarity check
+
+        summary = (
+            f"Numero: {validated_data.invoice_number}\n"
+            f"Data: {validated_data.invoice_date}\n"
+            f"Fornitore: {validated_data.supplier_name}\n"
+            f"Cliente: {validated_data.customer_name}\n"
+            f"Totale: €{validated_data.total_amount}"
+        )
+
+        # Path locale: cosine similarity tra embedding del testo OCR e
+        # dei campi estratti, senza round-trip LLM
+        if self._embedder is not None:
+            emb_ocr, emb_summary = list(
+                self._embedder.embed([ocr_text[:2000], summary])
+            )
+            # fastembed normalizza gli embedding: il dot product è il cosine
+            similarity = float(np.dot(emb_ocr, emb_summary))
+            return min(max(similarity, 0.0), 1.0)
+
+        # Fallback LLM se l'embedding locale non è disponibile
+        self._ensure_clients()
+
         prompt = f"""Confronta il testo OCR originale con i dati estratti e valuta la coerenza.
 
 TESTO ORIGINALE:
 {ocr_text[:1000]}
 
 DATI ESTRATTI:
-Numero: {validated_data.invoice_number}
-Data: {validated_data.invoice_date}
-Fornitore: {validated_data.supplier_name}
-Cliente: {validated_data.customer_name}
-Totale: €{validated_data.total_amount}
+{summary}
 
 Rispondi con un punteggio di coerenza da 0 a 1, dove:
 - 1.0 = dati perfettamente coerenti con il testo
@@ -298,17 +721,21 @@ Rispondi con un punteggio di coerenza da 0 a 1, dove:
 - 0.0 = dati completamente incoerenti
 
 Restituisci SOLO il numero (es. 0.85)"""
-        
-        response = self.client.chat.completions.create(
+
+        await self._limiter.acquire(estimated_tokens=len(prompt) // 4 + 10)
+
+        raw = await self.client.chat.completions.with_raw_response.create(
             model=self.deployment,
             messages=[{"role": "user", "content": prompt}],
             temperature=0,
             max_tokens=10
         )
-        
+        self._limiter.update_from_headers(raw.headers)
+        response = raw.parse()
+
         try:
             similarity_score = float(response.choices[0].message.content.strip())
             return min(max(similarity_score, 0.0), 1.0)
         except:
             return 0.5  # Default se parsing fallisce
-//* Validazione con Azure OpenAI */
+# Validazione con Azure OpenAI
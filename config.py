@@ -11,18 +11,30 @@ class Settings(BaseSettings):
     TEMP_DIR: Path = BASE_DIR / "temp"
     ARCHIVE_DIR: Path = BASE_DIR / "archive"
     LOGS_DIR: Path = BASE_DIR / "logs"
+    CACHE_DIR: Path = BASE_DIR / "cache"
     
     # OCR Configuration
     TESSERACT_PATH: str = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
     TESSERACT_LANG: str = "ita+eng"
     OCR_DPI: int = 300
     OCR_CONFIDENCE_THRESHOLD: float = 70.0
+    # Page segmentation mode di default (6 = blocco uniforme di testo);
+    # sovrascrivibile per layout particolari senza toccare il codice
+    OCR_PSM: int = 6
     
     # Azure OpenAI
     AZURE_OPENAI_ENDPOINT: str
     AZURE_OPENAI_KEY: str
     AZURE_OPENAI_DEPLOYMENT: str = "gpt-4"
     AZURE_OPENAI_API_VERSION: str = "2024-02-15-preview"
+    AZURE_OPENAI_RPM: int = 60
+    AZURE_OPENAI_TPM: int = 90000
+
+    # Endpoint di fallback (seconda region o compatibile OpenAI) usato
+    # quando il primario risponde 429/5xx
+    AZURE_OPENAI_FALLBACK_ENDPOINT: str = ""
+    AZURE_OPENAI_FALLBACK_KEY: str = ""
+    AZURE_OPENAI_FALLBACK_DEPLOYMENT: str = ""
     
     # Email Configuration
     EXCHANGE_EMAIL: str
@@ -31,6 +43,16 @@ class Settings(BaseSettings):
     INBOX_FOLDER: str = "Fatture"
     PROCESSED_FOLDER: str = "Fatture/Elaborate"
     
+    # Microsoft Graph webhook (notifiche push nuove email)
+    GRAPH_WEBHOOK_ENABLED: bool = False
+    GRAPH_WEBHOOK_HOST: str = "0.0.0.0"
+    GRAPH_WEBHOOK_PORT: int = 8443
+    GRAPH_NOTIFICATION_URL: str = ""
+    GRAPH_TENANT_ID: str = ""
+    GRAPH_CLIENT_ID: str = ""
+    GRAPH_CLIENT_SECRET: str = ""
+    GRAPH_CLIENT_STATE: str = "invoice-rpa"
+
     # Database
     DB_CONNECTION_STRING: str
     
@@ -44,6 +66,9 @@ class Settings(BaseSettings):
     AUTO_APPROVE_THRESHOLD: float = 5000.0
     
     # Processing Options
+    # Dump delle immagini intermedie in TEMP_DIR (encode PNG + I/O per
+    # fattura): solo per diagnosi, mai nei run batch di produzione
+    SAVE_DEBUG_IMAGES: bool = False
     BATCH_SIZE: int = 10
     MAX_RETRIES: int = 3
     RETRY_DELAY_SECONDS: int = 5
@@ -54,6 +79,16 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
-# Crea directories necessarie
-for directory in [settings.TEMP_DIR, settings.ARCHIVE_DIR, settings.LOGS_DIR]:
-    directory.mkdir(parents=True, exist_ok=True)
+def ensure_dirs() -> None:
+    """Crea le directories necessarie
+
+    Chiamata esplicitamente dall'entry point invece che a import time:
+    evita syscall a ogni import di config (worker, CLI, test).
+    """
+    for directory in [
+        settings.TEMP_DIR,
+        settings.ARCHIVE_DIR,
+        settings.LOGS_DIR,
+        settings.CACHE_DIR
+    ]:
+        directory.mkdir(parents=True, exist_ok=True)
@@ -1,8 +1,9 @@
 # database/invoice_repository.py
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, Text
+from sqlalchemy import create_engine, func, Column, Integer, String, Float, DateTime, Boolean, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from datetime import datetime
+from typing import Dict, List
+import orjson
 import structlog
 
 from config import settings
@@ -41,8 +42,10 @@ class Invoice(Base):
     validation_notes = Column(Text)
     error_message = Column(Text)
     
-    processed_at = Column(DateTime, default=datetime.now)
-    created_at = Column(DateTime, default=datetime.now)
+    # Timestamp riempiti dal DB: niente datetime Python per riga, e le
+    # bulk insert non devono includerli nel payload
+    processed_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime, server_default=func.now())
 
 class InvoiceRepository:
     """Repository per gestione fatture nel database"""
@@ -50,47 +53,92 @@ class InvoiceRepository:
     def __init__(self):
         self.logger = logger.bind(component="DBRepository")
         
-        self.engine = create_engine(settings.DB_CONNECTION_STRING)
+        # pre_ping valida le connessioni rimaste ferme tra un tick dello
+        # scheduler e l'altro; recycle preempta i timeout del firewall
+        self.engine = create_engine(
+            settings.DB_CONNECTION_STRING,
+            pool_size=20,
+            max_overflow=10,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            future=True
+        )
         Base.metadata.create_all(self.engine)
         
         self.Session = sessionmaker(bind=self.engine)
     
+    @staticmethod
+    def _to_row(invoice_data: Dict) -> Dict:
+        """Mappa dati fattura sulle colonne del modello Invoice"""
+        return {
+            'invoice_number': invoice_data.get('invoice_number', 'N/A'),
+            'invoice_date': invoice_data.get('invoice_date'),
+            'supplier_name': invoice_data.get('supplier_name'),
+            'supplier_vat': invoice_data.get('supplier_vat'),
+            'customer_name': invoice_data.get('customer_name'),
+            'customer_vat': invoice_data.get('customer_vat'),
+            'subtotal': invoice_data.get('subtotal'),
+            'vat_amount': invoice_data.get('vat_amount'),
+            'total_amount': invoice_data.get('total_amount'),
+            'currency': invoice_data.get('currency', 'EUR'),
+            'ocr_confidence': invoice_data.get('ocr_confidence'),
+            'ai_validation_score': invoice_data.get('ai_validation_score'),
+            'processing_status': invoice_data.get('processing_status', 'completed'),
+            'requires_manual_review': invoice_data.get('requires_manual_review', False),
+            'blob_url': invoice_data.get('blob_url'),
+            'file_name': invoice_data.get('file_name'),
+            'validation_notes': orjson.dumps(
+                invoice_data.get('validation_notes', [])
+            ).decode(),
+            'error_message': invoice_data.get('error_message')
+        }
+
     def save_invoice(self, invoice_data: Dict) -> int:
         """Salva fattura nel database"""
         session = self.Session()
-        
+
         try:
-            invoice = Invoice(
-                invoice_number=invoice_data.get('invoice_number', 'N/A'),
-                invoice_date=invoice_data.get('invoice_date'),
-                supplier_name=invoice_data.get('supplier_name'),
-                supplier_vat=invoice_data.get('supplier_vat'),
-                customer_name=invoice_data.get('customer_name'),
-                customer_vat=invoice_data.get('customer_vat'),
-                subtotal=invoice_data.get('subtotal'),
-                vat_amount=invoice_data.get('vat_amount'),
-                total_amount=invoice_data.get('total_amount'),
-                currency=invoice_data.get('currency', 'EUR'),
-                ocr_confidence=invoice_data.get('ocr_confidence'),
-                ai_validation_score=invoice_data.get('ai_validation_score'),
-                processing_status=invoice_data.get('processing_status', 'completed'),
-                requires_manual_review=invoice_data.get('requires_manual_review', False),
-                blob_url=invoice_data.get('blob_url'),
-                file_name=invoice_data.get('file_name'),
-                validation_notes=json.dumps(invoice_data.get('validation_notes', [])),
-                error_message=invoice_data.get('error_message')
-            )
-            
+            invoice = Invoice(**self._to_row(invoice_data))
+
             session.add(invoice)
             session.commit()
-            
+
             self.logger.info("Fattura salvata nel database", id=invoice.id)
-            
+
             return invoice.id
-            
+
         except Exception as e:
             session.rollback()
             self.logger.error("Errore salvataggio database", error=str(e))
             raise
         finally:
             session.close()
+
+    def save_invoices_bulk(self, invoices: List[Dict]) -> int:
+        """
+        Salva un batch di fatture con una sessione e un commit solo
+
+        Evita un round-trip (e un handshake di sessione) per fattura:
+        per i batch dello scheduler è un'unica INSERT multipla.
+        """
+        if not invoices:
+            return 0
+
+        rows = [self._to_row(data) for data in invoices]
+
+        session = self.Session()
+
+        try:
+            session.bulk_insert_mappings(Invoice, rows)
+            session.commit()
+
+            self.logger.info("Batch fatture salvato nel database", count=len(rows))
+
+            return len(rows)
+
+        except Exception as e:
+            session.rollback()
+            self.logger.error("Errore salvataggio batch database", error=str(e))
+            raise
+        finally:
+            session.close()
@@ -3,14 +3,24 @@ from exchangelib import (
     Credentials, Account, DELEGATE,
     FileAttachment, Message
 )
+import asyncio
 from pathlib import Path
-from typing import List
+from typing import Dict, List
+from datetime import datetime
+import re
+import shutil
 import structlog
 
 from config import settings
 
 logger = structlog.get_logger()
 
+# Match unico (keyword + estensione) compilato una volta: sostituisce
+# le due scansioni Python per-filename con un singolo search C-level
+_INVOICE_RE = re.compile(
+    r'(?i)^(?=.*(?:fattura|invoice|ft_|inv_)).*\.(?:pdf|png|jpe?g|tiff)$'
+)
+
 class EmailInvoiceMonitor:
     """Monitor casella email per nuove fatture"""
     
@@ -38,28 +48,37 @@ class EmailInvoiceMonitor:
         processed_folder = self.account.inbox / settings.PROCESSED_FOLDER
         
         invoice_files = []
-        
-        # Fetch unread emails
-        for item in inbox.filter(is_read=False):
+
+        # Fetch unread emails: solo i campi usati e paginazione a 100,
+        # per tagliare i round-trip EWS su inbox grosse
+        query = (
+            inbox.filter(is_read=False)
+            .only('subject', 'sender', 'attachments', 'is_read')
+            .order_by('datetime_received')
+        )
+        query.page_size = 100
+
+        for item in query:
             if not isinstance(item, Message):
                 continue
-            
+
             self.logger.info(
                 "Email ricevuta",
                 subject=item.subject,
                 from_email=item.sender.email_address
             )
-            
+
             # Process attachments
             for attachment in item.attachments:
                 if isinstance(attachment, FileAttachment):
                     if self._is_invoice_file(attachment.name):
                         file_path = self._save_attachment(attachment)
                         invoice_files.append(file_path)
-            
-            # Mark as read and move
+
+            # Mark as read and move: update_fields evita di
+            # ri-serializzare l'intero messaggio verso EWS
             item.is_read = True
-            item.save()
+            item.save(update_fields=['is_read'])
             item.move(processed_folder)
         
         self.logger.info("Fatture scaricate", count=len(invoice_files))
@@ -68,25 +87,20 @@ class EmailInvoiceMonitor:
     
     def _is_invoice_file(self, filename: str) -> bool:
         """Verifica se file è una fattura"""
-        invoice_keywords = ['fattura', 'invoice', 'ft_', 'inv_']
-        valid_extensions = ['.pdf', '.png', '.jpg', '.jpeg', '.tiff']
-        
-        filename_lower = filename.lower()
-        
-        has_keyword = any(kw in filename_lower for kw in invoice_keywords)
-        has_valid_ext = any(filename_lower.endswith(ext) for ext in valid_extensions)
-        
-        return has_keyword and has_valid_ext
+        return _INVOICE_RE.search(filename) is not None
     
     def _save_attachment(self, attachment: FileAttachment) -> Path:
-        """Salva allegato su disco"""
+        """Salva allegato su disco in streaming"""
         file_path = settings.TEMP_DIR / attachment.name
-        
-        with open(file_path, 'wb') as f:
-            f.write(attachment.content)
-        
+
+        # Copia a chunk da 1MB dallo stream EWS: evita di materializzare
+        # l'intero allegato in memoria (attachment.content) per PDF grossi
+        with attachment.fp as source, \
+                open(file_path, 'wb', buffering=1 << 20) as f:
+            shutil.copyfileobj(source, f, length=1 << 20)
+
         self.logger.debug("Attachment salvato", file=str(file_path))
-        
+
         return file_path
 
 # integrations/azure_storage.py
@@ -113,28 +127,96 @@ class AzureStorageManager:
         except ResourceExistsError:
             pass
     
+    @staticmethod
+    def _blob_name_for(file_path: Path, invoice_number: str) -> str:
+        """Nome blob organizzato per anno/mese"""
+        now = datetime.now()
+        return f"{now.year}/{now.month:02d}/{invoice_number}_{file_path.name}"
+
     def upload_invoice(
-        self, 
+        self,
         file_path: Path,
         invoice_number: str,
         metadata: Dict = None
     ) -> str:
         """Upload fattura su Azure Blob Storage"""
-        
-        # Organizza per anno/mese
-        now = datetime.now()
-        blob_name = f"{now.year}/{now.month:02d}/{invoice_number}_{file_path.name}"
-        
+
+        blob_name = self._blob_name_for(file_path, invoice_number)
+
         blob_client = self.container_client.get_blob_client(blob_name)
-        
+
         with open(file_path, 'rb') as data:
             blob_client.upload_blob(
                 data,
                 overwrite=True,
-                metadata=metadata or {}
+                metadata=metadata or {},
+                max_concurrency=8
             )
-        
+
         self.logger.info("Fattura archiviata", blob=blob_name)
-        
+
         return blob_client.url
-      //*  Integrazione Email e Storage */
+
+    def upload_invoices_batch(self, uploads: List[Dict]) -> Dict[str, str]:
+        """
+        Upload concorrente di un batch di fatture via client async
+
+        Le PUT HTTPS si sovrappongono invece di serializzarsi una
+        fattura alla volta dal ciclo dello scheduler.
+
+        Args:
+            uploads: Lista di dict con chiavi file_path, invoice_number
+                     e metadata (stessi argomenti di upload_invoice)
+
+        Returns:
+            Mappa file_path -> URL blob per gli upload riusciti
+        """
+        return asyncio.run(self._upload_batch_async(uploads))
+
+    async def _upload_batch_async(self, uploads: List[Dict]) -> Dict[str, str]:
+        from azure.storage.blob.aio import (
+            BlobServiceClient as AsyncBlobServiceClient
+        )
+
+        urls: Dict[str, str] = {}
+
+        async with AsyncBlobServiceClient.from_connection_string(
+            settings.AZURE_STORAGE_CONNECTION_STRING
+        ) as service:
+            container = service.get_container_client(
+                settings.BLOB_CONTAINER_NAME
+            )
+
+            async def _upload(upload: Dict) -> None:
+                file_path = Path(upload['file_path'])
+                blob_name = self._blob_name_for(
+                    file_path, upload['invoice_number']
+                )
+                blob_client = container.get_blob_client(blob_name)
+
+                with open(file_path, 'rb') as data:
+                    await blob_client.upload_blob(
+                        data,
+                        overwrite=True,
+                        metadata=upload.get('metadata') or {},
+                        max_concurrency=8
+                    )
+
+                urls[str(file_path)] = blob_client.url
+                self.logger.info("Fattura archiviata", blob=blob_name)
+
+            outcomes = await asyncio.gather(
+                *(_upload(u) for u in uploads),
+                return_exceptions=True
+            )
+
+        for upload, outcome in zip(uploads, outcomes):
+            if isinstance(outcome, Exception):
+                self.logger.error(
+                    "Errore upload blob",
+                    file=upload['file_path'],
+                    error=str(outcome)
+                )
+
+        return urls
+# Integrazione Email e Storage
@@ -0,0 +1,149 @@
+# integrations/graph_webhook.py
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+import structlog
+from aiohttp import web, ClientSession
+
+from config import settings
+
+logger = structlog.get_logger()
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_SCOPE = "https://graph.microsoft.com/.default"
+
+# Graph limita le subscription mail a ~3 giorni: rinnova con margine
+SUBSCRIPTION_LIFETIME = timedelta(hours=48)
+RENEWAL_INTERVAL_SECONDS = 36 * 3600
+
+class GraphWebhookListener:
+    """
+    Riceve change notification Microsoft Graph per le nuove email
+
+    Sostituisce il polling EWS a vuoto: l'elaborazione parte quando
+    arriva davvero una mail nella cartella fatture. Lo sweep schedulato
+    ogni 15 minuti resta come rete di sicurezza.
+    """
+
+    def __init__(self, on_new_mail: Callable[[], None]):
+        self.logger = logger.bind(component="GraphWebhook")
+        self.on_new_mail = on_new_mail
+        self._subscription_id = None
+
+    def start(self) -> None:
+        """Avvia il listener in un thread dedicato con il suo event loop"""
+        thread = threading.Thread(
+            target=lambda: asyncio.run(self._serve()),
+            name="graph-webhook",
+            daemon=True
+        )
+        thread.start()
+
+        self.logger.info(
+            "Listener webhook avviato",
+            port=settings.GRAPH_WEBHOOK_PORT
+        )
+
+    async def _serve(self) -> None:
+        app = web.Application()
+        app.router.add_post('/notification', self._handle_notification)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(
+            runner,
+            settings.GRAPH_WEBHOOK_HOST,
+            settings.GRAPH_WEBHOOK_PORT
+        )
+        await site.start()
+
+        # Sottoscrivi e rinnova finché il processo vive
+        while True:
+            try:
+                await self._ensure_subscription()
+            except Exception as e:
+                self.logger.error("Errore subscription Graph", error=str(e))
+
+            await asyncio.sleep(RENEWAL_INTERVAL_SECONDS)
+
+    async def _handle_notification(self, request: web.Request) -> web.Response:
+        # Handshake di validazione: Graph si aspetta il token in echo
+        validation_token = request.query.get('validationToken')
+        if validation_token:
+            return web.Response(text=validation_token)
+
+        payload = await request.json()
+
+        for notification in payload.get('value', []):
+            if notification.get('clientState') != settings.GRAPH_CLIENT_STATE:
+                self.logger.warning("Notifica con clientState non valido")
+                continue
+
+            self.logger.info("Nuova email notificata da Graph")
+
+            # Il callback è sincrono (pipeline RPA): non bloccare il loop
+            loop = asyncio.get_running_loop()
+            loop.run_in_executor(None, self.on_new_mail)
+
+        # Graph richiede risposta rapida, l'elaborazione è già in corso
+        return web.Response(status=202)
+
+    async def _get_token(self, session: ClientSession) -> str:
+        url = (
+            f"https://login.microsoftonline.com/"
+            f"{settings.GRAPH_TENANT_ID}/oauth2/v2.0/token"
+        )
+        async with session.post(url, data={
+            'client_id': settings.GRAPH_CLIENT_ID,
+            'client_secret': settings.GRAPH_CLIENT_SECRET,
+            'scope': GRAPH_SCOPE,
+            'grant_type': 'client_credentials'
+        }) as response:
+            response.raise_for_status()
+            return (await response.json())['access_token']
+
+    async def _ensure_subscription(self) -> None:
+        """Crea o rinnova la subscription sulla cartella fatture"""
+        expiration = (
+            datetime.now(timezone.utc) + SUBSCRIPTION_LIFETIME
+        ).isoformat()
+
+        async with ClientSession() as session:
+            token = await self._get_token(session)
+            headers = {'Authorization': f'Bearer {token}'}
+
+            if self._subscription_id:
+                async with session.patch(
+                    f"{GRAPH_BASE_URL}/subscriptions/{self._subscription_id}",
+                    headers=headers,
+                    json={'expirationDateTime': expiration}
+                ) as response:
+                    if response.status == 200:
+                        self.logger.info("Subscription rinnovata")
+                        return
+                    # Scaduta o rimossa: ricreala da zero
+                    self._subscription_id = None
+
+            async with session.post(
+                f"{GRAPH_BASE_URL}/subscriptions",
+                headers=headers,
+                json={
+                    'changeType': 'created',
+                    'notificationUrl': settings.GRAPH_NOTIFICATION_URL,
+                    'resource': (
+                        f"users/{settings.EXCHANGE_EMAIL}/mailFolders"
+                        f"('{settings.INBOX_FOLDER}')/messages"
+                    ),
+                    'expirationDateTime': expiration,
+                    'clientState': settings.GRAPH_CLIENT_STATE
+                }
+            ) as response:
+                response.raise_for_status()
+                self._subscription_id = (await response.json())['id']
+
+        self.logger.info(
+            "Subscription creata",
+            subscription_id=self._subscription_id
+        )
+# Notifiche push Microsoft Graph
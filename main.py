@@ -6,17 +6,14 @@ Automazione completa elaborazione fatture con OCR e AI
 """
 
 import sys
+import json
+import threading
 from pathlib import Path
+from typing import Dict, Optional
 import structlog
-import schedule
 import time
-from datetime import datetime
 
-from config import settings
-from rpa.invoice_processor import InvoiceProcessorRPA
-from integrations.email_monitor import EmailInvoiceMonitor
-from integrations.azure_storage import AzureStorageManager
-from database.invoice_repository import InvoiceRepository
+from config import settings, ensure_dirs
 
 # Setup logging
 structlog.configure(
@@ -35,16 +32,41 @@ class InvoiceRPAApplication:
     
     def __init__(self):
         self.logger = logger.bind(app="InvoiceRPA")
-        
+
+        # Import pigri: evitano di pagare exchangelib/sqlalchemy/azure a
+        # ogni avvio del modulo (cold-start scheduler, run_once da CLI)
+        from rpa.invoice_processor import InvoiceProcessorRPA
+        from integrations.email_monitor import (
+            EmailInvoiceMonitor, AzureStorageManager
+        )
+        from database.invoice_repository import InvoiceRepository
+
         self.processor = InvoiceProcessorRPA()
         self.email_monitor = EmailInvoiceMonitor()
         self.storage = AzureStorageManager()
         self.repository = InvoiceRepository()
-    
+
+        # Il ciclo può essere innescato sia dal webhook Graph (thread
+        # dell'executor) sia dallo sweep schedulato sul main thread:
+        # non è rientrante (stessa inbox, stessi stats, validatore
+        # condiviso), quindi una sola esecuzione alla volta
+        self._cycle_lock = threading.Lock()
+
     def process_new_invoices(self):
         """Job principale: elabora nuove fatture"""
+        if not self._cycle_lock.acquire(blocking=False):
+            self.logger.info("Ciclo già in corso, trigger ignorato")
+            return
+
+        try:
+            self._process_new_invoices_locked()
+        finally:
+            self._cycle_lock.release()
+
+    def _process_new_invoices_locked(self):
+        """Corpo del ciclo, eseguito sotto _cycle_lock"""
         self.logger.info("=== Inizio ciclo elaborazione ===")
-        
+
         try:
             # 1. Fetch da email
             invoice_files = self.email_monitor.fetch_new_invoices()
@@ -53,67 +75,93 @@ class InvoiceRPAApplication:
                 self.logger.info("Nessuna nuova fattura")
                 return
             
-            # 2. Elabora batch
-            results = self.processor.process_batch(
-                invoice_files,
-                max_workers=settings.BATCH_SIZE // 3
-            )
+            # 2. Elabora batch (un worker per core, cap sul numero file)
+            results = self.processor.process_batch(invoice_files)
             
-            # 3. Salva risultati
+            # 3. Upload batch su Azure Storage (PUT concorrenti)
+            successes = [r for r in results if r['status'] == 'success']
+            blob_urls = self.storage.upload_invoices_batch([
+                {
+                    'file_path': r['file_path'],
+                    'invoice_number': r['invoice_data']['invoice_number'],
+                    'metadata': {
+                        'supplier': r['invoice_data']['supplier_name'],
+                        'amount': str(r['invoice_data']['total_amount']),
+                        'date': r['invoice_data']['invoice_date']
+                    }
+                }
+                for r in successes
+            ]) if successes else {}
+
+            # 4. Salva risultati: accumula le righe e scrivile sul DB
+            # con una insert sola invece di un commit per fattura
+            rows = []
             for result in results:
                 if result['status'] == 'success':
-                    self._handle_successful_invoice(result)
+                    row = self._handle_successful_invoice(
+                        result,
+                        blob_urls.get(result['file_path'])
+                    )
+                    if row:
+                        rows.append(row)
                 else:
                     self._handle_failed_invoice(result)
+
+            if rows:
+                self.repository.save_invoices_bulk(rows)
             
-            # 4. Report
+            # 5. Report
             stats = self.processor.get_stats()
             self.logger.info("Ciclo completato", **stats)
             
         except Exception as e:
             self.logger.error("Errore ciclo elaborazione", error=str(e), exc_info=True)
     
-    def _handle_successful_invoice(self, result: Dict):
-        """Gestisce fattura elaborata con successo"""
+    def _handle_successful_invoice(
+        self,
+        result: Dict,
+        blob_url: Optional[str]
+    ) -> Optional[Dict]:
+        """
+        Gestisce fattura elaborata con successo
+
+        Returns:
+            Riga pronta per save_invoices_bulk, None se upload fallito
+        """
         invoice_data = result['invoice_data']
         file_path = Path(result['file_path'])
-        
-        try:
-            # Upload su Azure Storage
-            blob_url = self.storage.upload_invoice(
-                file_path,
-                invoice_data['invoice_number'],
-                metadata={
-                    'supplier': invoice_data['supplier_name'],
-                    'amount': str(invoice_data['total_amount']),
-                    'date': invoice_data['invoice_date']
-                }
+
+        if blob_url is None:
+            self.logger.error(
+                "Upload blob fallito, fattura non archiviata",
+                invoice=invoice_data.get('invoice_number')
             )
-            
-            # Salva su database
-            self.repository.save_invoice({
-                **invoice_data,
-                'blob_url': blob_url,
-                'processing_status': 'completed' if not invoice_data['requires_manual_review'] else 'review',
-                'processed_at': datetime.now().isoformat()
-            })
-            
+            return None
+
+        try:
             # Archive file locale
             archive_path = settings.ARCHIVE_DIR / file_path.name
             file_path.rename(archive_path)
-            
+
             self.logger.info(
                 "Fattura salvata",
                 invoice_number=invoice_data['invoice_number'],
                 requires_review=invoice_data['requires_manual_review']
             )
-            
+
+            return {
+                **invoice_data,
+                'blob_url': blob_url,
+                'processing_status': 'completed' if not invoice_data['requires_manual_review'] else 'review'
+            }
+
         except Exception as e:
             self.logger.error(
                 "Errore salvataggio fattura",
                 invoice=invoice_data.get('invoice_number'),
                 error=str(e)
             )
+            return None
     
     def _handle_failed_invoice(self, result: Dict):
         """Gestisce fattura con errori"""
@@ -123,8 +171,7 @@ class InvoiceRPAApplication:
         self.repository.save_invoice({
             'file_name': file_path.name,
             'processing_status': 'failed',
-            'error_message': result['error'],
-            'processed_at': datetime.now().isoformat()
+            'error_message': result['error']
         })
         
         # Sposta in cartella errori
@@ -142,9 +189,19 @@ class InvoiceRPAApplication:
     
     def run_scheduler(self):
         """Avvia scheduler per elaborazione automatica"""
+        import schedule
+
         self.logger.info("Avvio scheduler RPA")
-        
-        # Schedule ogni 15 minuti
+
+        # Notifiche push Graph: elabora appena arriva una mail invece
+        # di attendere il prossimo tick
+        if settings.GRAPH_WEBHOOK_ENABLED:
+            from integrations.graph_webhook import GraphWebhookListener
+            listener = GraphWebhookListener(self.process_new_invoices)
+            listener.start()
+
+        # Schedule ogni 15 minuti (sweep di sicurezza quando il webhook
+        # è attivo, ciclo principale altrimenti)
         schedule.every(15).minutes.do(self.process_new_invoices)
         
         # Schedule report giornaliero
@@ -164,6 +221,8 @@ class InvoiceRPAApplication:
 
 def main():
     """Entry point"""
+    ensure_dirs()
+
     app = InvoiceRPAApplication()
     
     if len(sys.argv) > 1:
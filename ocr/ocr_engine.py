@@ -3,23 +3,136 @@ import pytesseract
 from pytesseract import Output
 import cv2
 import numpy as np
+from collections import defaultdict
 from pathlib import Path
 from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import re
 import structlog
 
 from config import settings
 
+# Backend regex DFA opzionali: hyperscan scansiona tutti i pattern in
+# una passata vettorizzata, re2 garantisce matching lineare. I pattern
+# usati qui sono tutti DFA-compatibili (niente backreference/lookaround);
+# il path `re` puro resta il default portabile
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# tesserocr usa libtesseract in-process: una sola load del traineddata
+# per processo invece di un fork+exec del binario (e relativo reload
+# del modello) per ogni pagina. pytesseract resta il fallback portabile
+try:
+    from tesserocr import OEM, PSM, RIL, PyTessBaseAPI
+except ImportError:
+    PyTessBaseAPI = None
+
 logger = structlog.get_logger()
 
+# Flag Tesseract comuni: --oem 1 seleziona la sola pipeline LSTM
+# (con traineddata *.fast è nettamente più veloce di --oem 3, che può
+# ricadere sul motore legacy); le immagini arrivano già binarizzate dal
+# preprocessing, quindi inversione e dizionari interni sono lavoro
+# ridondante e vengono disabilitati
+_TESSERACT_FAST_FLAGS = (
+    '--oem 1 '
+    '-c tessedit_do_invert=0 '
+    '-c load_system_dawg=0 '
+    '-c load_freq_dawg=0'
+)
+
+# Regex di supporto compilate a livello modulo, fuori dal path caldo
+_RE_NON_DIGIT = re.compile(r'[^\d]')
+# Pattern per righe prodotto: descrizione, quantità, prezzo
+_RE_LINE_ITEM = re.compile(r'(.+?)\s+(\d+)\s+€?\s*([\d\.,]+)')
+
+# Pattern per estrazione campi, raggruppati per tipo
+_FIELD_PATTERNS = {
+    'invoice_number': [
+        r'(?:fattura|invoice|n[°\.º]?)\s*[:\-]?\s*(\d{4,}[/\-]?\d*)',
+        r'(?:FT|INV|DOC)[:\-\s]*(\d{4,})',
+        r'numero\s+(?:fattura|documento)[:\s]+(\d+)',
+    ],
+    'date': [
+        r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})',
+        r'(\d{4}[/\-\.]\d{1,2}[/\-\.]\d{1,2})',
+    ],
+    'vat_number': [
+        r'(?:p\.?\s*iva|partita\s+iva|vat)[:\s]*(\d{11})',
+        r'(?:tax\s+id|fiscal\s+code)[:\s]*(\d{11})',
+    ],
+    'amount': [
+        r'(?:totale|total|importo)[:\s]+€?\s*([\d\.,]+)',
+        r'(?:grand\s+total|net\s+amount)[:\s]+€?\s*([\d\.,]+)',
+    ],
+    'email': [
+        r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
+    ]
+}
+
+@dataclass
+class WordArrays:
+    """Dati word-level in formato colonnare (un array per campo)
+
+    Rispetto alla lista di dict equivalente pesa ~10x meno (niente
+    header dict e int boxed per parola) e permette statistiche e
+    lookup vettorizzati sulle colonne contigue.
+    """
+    text: np.ndarray        # dtype=object
+    confidence: np.ndarray  # int32
+    left: np.ndarray        # int32
+    top: np.ndarray         # int32
+    width: np.ndarray       # int32
+    height: np.ndarray      # int32
+    block_num: np.ndarray   # int32
+    line_num: np.ndarray    # int32
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def bbox(self, i: int) -> Tuple[int, int, int, int]:
+        """Bounding box (x, y, w, h) della parola i"""
+        return (
+            int(self.left[i]),
+            int(self.top[i]),
+            int(self.width[i]),
+            int(self.height[i])
+        )
+
 @dataclass
 class OCRResult:
     """Risultato estrazione OCR"""
     text: str
     confidence: float
-    word_data: List[Dict]
+    words: WordArrays
     layout_data: Optional[Dict] = None
+    _word_dicts: Optional[List[Dict]] = field(
+        default=None, repr=False, compare=False
+    )
+
+    @property
+    def word_data(self) -> List[Dict]:
+        """Vista list-of-dict legacy, materializzata pigramente"""
+        if self._word_dicts is None:
+            words = self.words
+            self._word_dicts = [
+                {
+                    'text': words.text[i],
+                    'confidence': int(words.confidence[i]),
+                    'bbox': words.bbox(i),
+                    'block_num': int(words.block_num[i]),
+                    'line_num': int(words.line_num[i])
+                }
+                for i in range(len(words))
+            ]
+        return self._word_dicts
 
 @dataclass
 class InvoiceField:
@@ -35,46 +148,139 @@ class InvoiceOCREngine:
     def __init__(self):
         self.logger = logger.bind(component="OCREngine")
         pytesseract.pytesseract.tesseract_cmd = settings.TESSERACT_PATH
-        
-        # Pattern regex per estrazione dati
+
+        # API libtesseract persistente, una per engine (= per processo
+        # worker): il traineddata viene caricato qui e riusato da tutte
+        # le extract_text successive
+        self.api = None
+        if PyTessBaseAPI is not None:
+            try:
+                self.api = PyTessBaseAPI(
+                    lang=settings.TESSERACT_LANG,
+                    psm=PSM(settings.OCR_PSM),
+                    oem=OEM.LSTM_ONLY
+                )
+                for variable in (
+                    'tessedit_do_invert',
+                    'load_system_dawg',
+                    'load_freq_dawg'
+                ):
+                    self.api.SetVariable(variable, '0')
+            except Exception as e:
+                self.logger.warning(
+                    "tesserocr non inizializzabile, uso pytesseract",
+                    error=str(e)
+                )
+                self.api = None
+
+        # Pattern regex per estrazione dati, compilati una volta alla
+        # costruzione invece che ad ogni search per fattura
         self.patterns = {
-            'invoice_number': [
-                r'(?:fattura|invoice|n[°\.º]?)\s*[:\-]?\s*(\d{4,}[/\-]?\d*)',
-                r'(?:FT|INV|DOC)[:\-\s]*(\d{4,})',
-                r'numero\s+(?:fattura|documento)[:\s]+(\d+)',
-            ],
-            'date': [
-                r'(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})',
-                r'(\d{4}[/\-\.]\d{1,2}[/\-\.]\d{1,2})',
-            ],
-            'vat_number': [
-                r'(?:p\.?\s*iva|partita\s+iva|vat)[:\s]*(\d{11})',
-                r'(?:tax\s+id|fiscal\s+code)[:\s]*(\d{11})',
-            ],
-            'amount': [
-                r'(?:totale|total|importo)[:\s]+€?\s*([\d\.,]+)',
-                r'(?:grand\s+total|net\s+amount)[:\s]+€?\s*([\d\.,]+)',
-            ],
-            'email': [
-                r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
+            field_type: [
+                re.compile(p, re.IGNORECASE | re.MULTILINE)
+                for p in raw_patterns
             ]
+            for field_type, raw_patterns in _FIELD_PATTERNS.items()
         }
+
+        # Alternation unica con gruppi nominati: l'estrazione campi fa
+        # una sola passata lineare sul testo OCR invece di una scansione
+        # completa per ogni pattern
+        parts = []
+        for field_type, raw_patterns in _FIELD_PATTERNS.items():
+            for i, raw in enumerate(raw_patterns):
+                parts.append(f'(?P<{field_type}_{i}>{raw})')
+
+        # Con re2 disponibile l'alternation gira su un DFA lineare;
+        # l'API di match usata sotto è compatibile con re
+        engine = re2 if re2 is not None else re
+        self._combined = engine.compile(
+            '|'.join(parts),
+            re.IGNORECASE | re.MULTILINE
+        )
+
+        # Per ogni gruppo wrapper, indice del gruppo che porta il valore
+        # (il primo sottogruppo del pattern, o il wrapper stesso)
+        self._value_group = {}
+        for field_type, raw_patterns in _FIELD_PATTERNS.items():
+            for i, raw in enumerate(raw_patterns):
+                name = f'{field_type}_{i}'
+                idx = self._combined.groupindex[name]
+                has_inner = re.compile(raw).groups > 0
+                self._value_group[name] = idx + 1 if has_inner else idx
+
+        # Database hyperscan per lo scan multi-pattern a blocchi SIMD;
+        # i gruppi di cattura non esistono in hyperscan, quindi il
+        # valore viene ri-estratto sul solo span decodificato (una
+        # manciata di caratteri, mai il testo intero) con il pattern
+        # str già compilato: i pattern hanno letterali multi-byte e
+        # `re` su bytes non ha una modalità UTF-8
+        self._hs_db = None
+        self._hs_fields = []
+        if hyperscan is not None:
+            try:
+                expressions = []
+                patterns_flat = []
+                for field_type, raw_patterns in _FIELD_PATTERNS.items():
+                    for i, raw in enumerate(raw_patterns):
+                        expressions.append(raw.encode())
+                        self._hs_fields.append(field_type)
+                        patterns_flat.append(self.patterns[field_type][i])
+                self._hs_patterns = patterns_flat
+
+                # I pattern contengono letterali multi-byte (€, °, º):
+                # senza UTF8 i quantificatori si legherebbero all'ultimo
+                # byte della sequenza (€? diventerebbe \xe2\x82 + \xac
+                # opzionale) e il backend divergerebbe dal path `re`
+                db = hyperscan.Database()
+                db.compile(
+                    expressions=expressions,
+                    ids=list(range(len(expressions))),
+                    flags=[
+                        hyperscan.HS_FLAG_CASELESS
+                        | hyperscan.HS_FLAG_MULTILINE
+                        | hyperscan.HS_FLAG_SOM_LEFTMOST
+                        | hyperscan.HS_FLAG_UTF8
+                        | hyperscan.HS_FLAG_UCP
+                    ] * len(expressions)
+                )
+                self._hs_db = db
+            except Exception as e:
+                self.logger.warning(
+                    "Pattern non compilabili con hyperscan, uso re",
+                    error=str(e)
+                )
+                self._hs_db = None
     
     def extract_text(
-        self, 
+        self,
         image: np.ndarray,
-        config: str = '--oem 3 --psm 6'
+        config: Optional[str] = None,
+        psm: Optional[int] = None
     ) -> OCRResult:
         """
         Estrae testo da immagine con dati dettagliati
-        
+
         Args:
             image: Immagine preprocessata
-            config: Configurazione Tesseract
-            
+            config: Configurazione Tesseract (default: flag fast + OCR_PSM)
+            psm: Override del page segmentation mode per singola chiamata
+                 (es. crop header/footer da detect_document_regions)
+
         Returns:
             OCRResult con testo e metadati
         """
+        # Config custom forza il path pytesseract (le stringhe CLI non
+        # mappano sull'API in-process); il default usa l'istanza warm
+        if self.api is not None and config is None:
+            return self._extract_text_tesserocr(image, psm)
+
+        if config is None:
+            config = (
+                f'{_TESSERACT_FAST_FLAGS} '
+                f'--psm {psm if psm is not None else settings.OCR_PSM}'
+            )
+
         self.logger.info("Inizio estrazione OCR")
         
         # Estrazione con layout data
@@ -92,130 +298,316 @@ class InvoiceOCREngine:
             config=config
         )
         
-        # Filtra parole con confidence bassa
-        word_data = []
-        confidences = []
-        
-        for i in range(len(data['text'])):
-            conf = int(data['conf'][i])
-            if conf > 0:
-                word_data.append({
-                    'text': data['text'][i],
-                    'confidence': conf,
-                    'bbox': (
-                        data['left'][i],
-                        data['top'][i],
-                        data['width'][i],
-                        data['height'][i]
-                    ),
-                    'block_num': data['block_num'][i],
-                    'line_num': data['line_num'][i]
-                })
-                confidences.append(conf)
-        
-        avg_confidence = np.mean(confidences) if confidences else 0
-        
+        # Filtra parole con confidence bassa: conversione e maschera
+        # vettorizzate invece di un int() per token in Python, e le
+        # colonne restano array (SoA) senza materializzare dict
+        conf = np.asarray(data['conf'], dtype=np.float32).astype(np.int32)
+        kept = np.nonzero(conf > 0)[0]
+
+        texts = data['text']
+        words = WordArrays(
+            text=np.array([texts[i] for i in kept], dtype=object),
+            confidence=conf[kept],
+            left=np.asarray(data['left'], dtype=np.int32)[kept],
+            top=np.asarray(data['top'], dtype=np.int32)[kept],
+            width=np.asarray(data['width'], dtype=np.int32)[kept],
+            height=np.asarray(data['height'], dtype=np.int32)[kept],
+            block_num=np.asarray(data['block_num'], dtype=np.int32)[kept],
+            line_num=np.asarray(data['line_num'], dtype=np.int32)[kept]
+        )
+
+        avg_confidence = float(conf[kept].mean()) if kept.size else 0
+
         self.logger.info(
             "OCR completato",
-            words_extracted=len(word_data),
+            words_extracted=len(words),
             avg_confidence=f"{avg_confidence:.2f}%"
         )
-        
+
         return OCRResult(
             text=text,
             confidence=avg_confidence,
-            word_data=word_data,
+            words=words,
             layout_data=data
         )
     
+    def _extract_text_tesserocr(
+        self,
+        image: np.ndarray,
+        psm: Optional[int] = None
+    ) -> OCRResult:
+        """Estrazione via API libtesseract persistente
+
+        Una sola passata OCR fornisce testo, bbox e confidence tramite
+        il result iterator: niente seconda invocazione image_to_string
+        né parsing del dict di image_to_data.
+        """
+        self.logger.info("Inizio estrazione OCR")
+
+        if psm is not None:
+            self.api.SetPageSegMode(PSM(psm))
+
+        buffer = np.ascontiguousarray(image)
+        height, width = buffer.shape[:2]
+        self.api.SetImageBytes(buffer.tobytes(), width, height, 1, width)
+
+        try:
+            text = self.api.GetUTF8Text()
+
+            texts = []
+            rows = []
+            block_num = 0
+            line_num = 0
+
+            iterator = self.api.GetIterator()
+            if iterator is not None:
+                while True:
+                    if iterator.IsAtBeginningOf(RIL.BLOCK):
+                        block_num += 1
+                        line_num = 0
+                    if iterator.IsAtBeginningOf(RIL.TEXTLINE):
+                        line_num += 1
+
+                    word = iterator.GetUTF8Text(RIL.WORD)
+                    confidence = iterator.Confidence(RIL.WORD)
+
+                    if word and confidence > 0:
+                        x1, y1, x2, y2 = iterator.BoundingBox(RIL.WORD)
+                        texts.append(word)
+                        rows.append((
+                            int(confidence),
+                            x1, y1, x2 - x1, y2 - y1,
+                            block_num, line_num
+                        ))
+
+                    if not iterator.Next(RIL.WORD):
+                        break
+        finally:
+            if psm is not None:
+                self.api.SetPageSegMode(PSM(settings.OCR_PSM))
+
+        columns = np.array(rows, dtype=np.int32).reshape(len(rows), 7).T
+        words = WordArrays(
+            text=np.array(texts, dtype=object),
+            confidence=columns[0],
+            left=columns[1],
+            top=columns[2],
+            width=columns[3],
+            height=columns[4],
+            block_num=columns[5],
+            line_num=columns[6]
+        )
+
+        avg_confidence = (
+            float(words.confidence.mean()) if len(words) else 0
+        )
+
+        self.logger.info(
+            "OCR completato",
+            words_extracted=len(words),
+            avg_confidence=f"{avg_confidence:.2f}%"
+        )
+
+        return OCRResult(
+            text=text,
+            confidence=avg_confidence,
+            words=words
+        )
+
+    def extract_text_batch(self, images: List[np.ndarray]) -> List['OCRResult']:
+        """Estrae testo da più immagini in una sessione Tesseract sola
+
+        Con tesserocr l'init e il caricamento del traineddata sono già
+        pagati una volta per engine: il loop riusa lo stato del
+        recognizer per tutte le pagine del chunk. Con il fallback
+        pytesseract degrada a invocazioni indipendenti.
+        """
+        return [self.extract_text(image) for image in images]
+
+    def close(self) -> None:
+        """Rilascia l'API libtesseract (no-op con pytesseract)"""
+        if self.api is not None:
+            self.api.End()
+            self.api = None
+
+    def __del__(self):
+        self.close()
+
     def extract_invoice_fields(
-        self, 
+        self,
         text: str,
-        word_data: List[Dict]
+        words: WordArrays
     ) -> Dict[str, InvoiceField]:
         """
         Estrae campi strutturati da testo OCR
-        
+
         Args:
             text: Testo estratto
-            word_data: Dati word-level da OCR
-            
+            words: Dati word-level colonnari da OCR
+
         Returns:
             Dizionario con campi estratti
         """
+        if self._hs_db is not None:
+            raw_values = self._scan_fields_hyperscan(text)
+        else:
+            raw_values = self._scan_fields_combined(text)
+
+        # Indici costruiti una volta per fattura: testi lowercased,
+        # mappa token->indici, testo concatenato e tabella offset
+        # char->parola. I lookup per campo diventano find/accessi a
+        # dict invece di scansioni O(N) con un .lower() per parola; la
+        # colonna confidence è già un array
+        lowered_texts = [t.lower() for t in words.text]
+        token_index = defaultdict(list)
+        for i, token in enumerate(lowered_texts):
+            token_index[token].append(i)
+        conf_arr = words.confidence
+
+        joined_lower = ' '.join(lowered_texts)
+        # Ogni parola copre i suoi caratteri più lo spazio separatore:
+        # char_to_word[pos] è l'indice della parola al carattere pos
+        char_to_word = np.repeat(
+            np.arange(len(lowered_texts), dtype=np.int32),
+            [len(token) + 1 for token in lowered_texts]
+        )
+
         fields = {}
-        
-        # Estrai ogni tipo di campo
-        for field_type, patterns in self.patterns.items():
-            field = self._extract_field(text, patterns, word_data, field_type)
-            if field:
-                fields[field_type] = field
-        
+        for field_type, value in raw_values.items():
+            # Trova bbox dalle colonne word-level (unione sulle parole
+            # coperte dal match, corretto anche per valori multi-parola)
+            bbox = self._find_bbox_for_text(
+                value, words, joined_lower, char_to_word
+            )
+
+            # Calcola confidence media per questo campo
+            confidence = self._calculate_field_confidence(
+                value, lowered_texts, token_index, conf_arr
+            )
+
+            fields[field_type] = InvoiceField(
+                value=value.strip(),
+                confidence=confidence,
+                bbox=bbox,
+                field_type=field_type
+            )
+
         # Post-processing specifico
         fields = self._post_process_fields(fields)
-        
+
         return fields
-    
-    def _extract_field(
-        self,
-        text: str,
-        patterns: List[str],
-        word_data: List[Dict],
-        field_type: str
-    ) -> Optional[InvoiceField]:
-        """Estrae singolo campo usando pattern regex"""
-        
-        for pattern in patterns:
-            match = re.search(pattern, text, re.IGNORECASE | re.MULTILINE)
+
+    def _scan_fields_combined(self, text: str) -> Dict[str, str]:
+        """Singola passata sull'alternation combinata (re / re2)
+
+        Il primo match per field_type vince, poi si esce in anticipo.
+        """
+        values = {}
+
+        for match in self._combined.finditer(text):
+            group_name = match.lastgroup
+            if group_name is None:
+                continue
+
+            field_type = group_name.rsplit('_', 1)[0]
+            if field_type in values:
+                continue
+
+            values[field_type] = match.group(self._value_group[group_name])
+
+            if len(values) == len(self.patterns):
+                break
+
+        return values
+
+    def _scan_fields_hyperscan(self, text: str) -> Dict[str, str]:
+        """Scan multi-pattern hyperscan, prima occorrenza per field_type"""
+        raw = text.encode()
+        hits = {}
+
+        def on_match(pattern_id, start, end, flags, context):
+            field_type = self._hs_fields[pattern_id]
+            previous = hits.get(field_type)
+            if previous is None or start < previous[1]:
+                hits[field_type] = (pattern_id, start, end)
+
+        self._hs_db.scan(raw, match_event_handler=on_match)
+
+        values = {}
+        for field_type, (pattern_id, start, end) in hits.items():
+            # Hyperscan non cattura gruppi: decodifica il solo span
+            # individuato (pochi caratteri) e ri-esegui il pattern str
+            # per estrarre il valore
+            span = raw[start:end].decode(errors='ignore')
+            match = self._hs_patterns[pattern_id].search(span)
             if match:
-                value = match.group(1) if match.groups() else match.group(0)
-                
-                # Trova bbox approssimativo dal word_data
-                bbox = self._find_bbox_for_text(value, word_data)
-                
-                # Calcola confidence media per questo campo
-                confidence = self._calculate_field_confidence(value, word_data)
-                
-                return InvoiceField(
-                    value=value.strip(),
-                    confidence=confidence,
-                    bbox=bbox,
-                    field_type=field_type
+                values[field_type] = (
+                    match.group(1) if match.groups() else match.group(0)
                 )
-        
-        return None
+
+        return values
     
     def _find_bbox_for_text(
-        self, 
-        text: str, 
-        word_data: List[Dict]
+        self,
+        text: str,
+        words: WordArrays,
+        joined_lower: str,
+        char_to_word: np.ndarray
     ) -> Tuple[int, int, int, int]:
-        """Trova bounding box per testo specifico"""
-        
-        # Cerca corrispondenza parziale nelle parole estratte
-        for word in word_data:
-            if text.lower() in word['text'].lower():
-                return word['bbox']
-        
-        # Default bbox se non trovato
-        return (0, 0, 0, 0)
-    
+        """Trova bounding box per testo specifico
+
+        Un find sul testo concatenato individua il match anche quando
+        il valore attraversa più parole (es. importi con valuta); la
+        tabella char->parola dà l'intervallo di parole coperte e il
+        bbox è l'unione dei loro, calcolata su slice numpy.
+        """
+        if not joined_lower:
+            return (0, 0, 0, 0)
+
+        pos = joined_lower.find(text.lower())
+        if pos == -1:
+            return (0, 0, 0, 0)
+
+        w_start = int(char_to_word[pos])
+        w_end = int(char_to_word[min(
+            pos + len(text) - 1, len(char_to_word) - 1
+        )])
+
+        left = words.left[w_start:w_end + 1]
+        top = words.top[w_start:w_end + 1]
+        x = int(left.min())
+        y = int(top.min())
+        x2 = int((left + words.width[w_start:w_end + 1]).max())
+        y2 = int((top + words.height[w_start:w_end + 1]).max())
+
+        return (x, y, x2 - x, y2 - y)
+
     def _calculate_field_confidence(
-        self, 
-        value: str, 
-        word_data: List[Dict]
+        self,
+        value: str,
+        lowered_texts: List[str],
+        token_index: Dict[str, List[int]],
+        conf_arr: np.ndarray
     ) -> float:
         """Calcola confidence per un campo specifico"""
-        
-        # Trova parole che matchano il valore
-        matching_words = [
-            w for w in word_data 
-            if any(part.lower() in w['text'].lower() for part in value.split())
-        ]
-        
-        if matching_words:
-            return np.mean([w['confidence'] for w in matching_words])
-        
+
+        # Unione degli indici delle parole che matchano il valore
+        indices = set()
+        for part in value.split():
+            part = part.lower()
+            exact = token_index.get(part)
+            if exact:
+                indices.update(exact)
+            else:
+                indices.update(
+                    i for i, lowered in enumerate(lowered_texts)
+                    if part in lowered
+                )
+
+        if indices:
+            idx = np.fromiter(indices, dtype=np.int64, count=len(indices))
+            return float(conf_arr[idx].mean())
+
         return 0.0
     
     def _post_process_fields(
@@ -227,7 +619,7 @@ class InvoiceOCREngine:
         # Normalizza P.IVA
         if 'vat_number' in fields:
             vat = fields['vat_number'].value
-            vat = re.sub(r'[^\d]', '', vat)  # Solo numeri
+            vat = _RE_NON_DIGIT.sub('', vat)  # Solo numeri
             if len(vat) == 11:
                 fields['vat_number'].value = vat
             else:
@@ -287,10 +679,13 @@ class InvoiceOCREngine:
         for table in table_regions:
             table_img = table['image']
             
-            # OCR sulla tabella
+            # OCR sulla tabella: psm 4 (colonna singola a righe di
+            # larghezza variabile) segmenta le righe tabellari meglio
+            # e più in fretta del psm di default
             table_data = pytesseract.image_to_data(
                 table_img,
                 lang=settings.TESSERACT_LANG,
+                config=f'{_TESSERACT_FAST_FLAGS} --psm 4',
                 output_type=Output.DICT
             )
             
@@ -307,9 +702,7 @@ class InvoiceOCREngine:
             for line_texts in lines.values():
                 line_text = ' '.join(line_texts)
                 
-                # Pattern per righe prodotto: descrizione, quantità, prezzo
-                item_pattern = r'(.+?)\s+(\d+)\s+€?\s*([\d\.,]+)'
-                match = re.search(item_pattern, line_text)
+                match = _RE_LINE_ITEM.search(line_text)
                 
                 if match:
                     line_items.append({
@@ -329,30 +722,30 @@ class InvoiceOCREngine:
         """Crea visualizzazione OCR con bounding boxes"""
         
         vis_img = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-        
-        # Disegna bbox per ogni parola
-        for word in ocr_result.word_data:
-            x, y, w, h = word['bbox']
-            conf = word['confidence']
-            
-            # Colore basato su confidence
-            if conf > 80:
-                color = (0, 255, 0)  # Verde
-            elif conf > 60:
-                color = (0, 255, 255)  # Giallo
-            else:
-                color = (0, 0, 255)  # Rosso
-            
-            cv2.rectangle(vis_img, (x, y), (x + w, y + h), color, 2)
-            cv2.putText(
-                vis_img,
-                f"{conf}%",
-                (x, y - 5),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                0.4,
-                color,
-                1
-            )
-        
+
+        # Classificazione colore vettorizzata con np.select, poi un
+        # loop per fascia sulle sole parole filtrate: niente branch
+        # Python per parola
+        words = ocr_result.words
+        conf = words.confidence
+        tier = np.select([conf > 80, conf > 60], [0, 1], default=2)
+
+        # Verde / giallo / rosso
+        colors = ((0, 255, 0), (0, 255, 255), (0, 0, 255))
+
+        for tier_idx, color in enumerate(colors):
+            for i in np.nonzero(tier == tier_idx)[0]:
+                x, y, w, h = words.bbox(i)
+                cv2.rectangle(vis_img, (x, y), (x + w, y + h), color, 2)
+                cv2.putText(
+                    vis_img,
+                    f"{int(conf[i])}%",
+                    (x, y - 5),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.4,
+                    color,
+                    1
+                )
+
         cv2.imwrite(str(output_path), vis_img)
-     //*  OCR Engine Avanzato */
+# OCR Engine Avanzato
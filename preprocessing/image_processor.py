@@ -2,45 +2,139 @@
 import cv2
 import numpy as np
 from pathlib import Path
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Union
 import structlog
 
+# Numba è un acceleratore opzionale: se presente, i primi stadi della
+# pipeline vengono fusi in un kernel solo (vedi _fused_gray_blur)
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
 logger = structlog.get_logger()
 
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _fused_gray_blur(bgr):
+        """Grayscale + gaussiana 3x3 + istogramma in un passaggio solo
+
+        Ogni stadio separato della pipeline rilegge e riscrive l'intera
+        immagine (~9 MB a passata): fondendo conversione, smoothing e
+        istogramma i pixel attraversano la DRAM una volta sola. Il
+        grigio dei vicini viene ricalcolato al volo invece di essere
+        bufferizzato: più FLOP, meno traffico di memoria.
+        """
+        height, width = bgr.shape[0], bgr.shape[1]
+        out = np.empty((height, width), dtype=np.uint8)
+        hist = np.zeros((height, 256), dtype=np.int32)
+
+        for y in prange(height):
+            for x in range(width):
+                acc = 0.0
+                for dy in range(-1, 2):
+                    yy = min(max(y + dy, 0), height - 1)
+                    wy = 2 - abs(dy)
+                    for dx in range(-1, 2):
+                        xx = min(max(x + dx, 0), width - 1)
+                        gray = (
+                            0.114 * bgr[yy, xx, 0]
+                            + 0.587 * bgr[yy, xx, 1]
+                            + 0.299 * bgr[yy, xx, 2]
+                        )
+                        acc += gray * wy * (2 - abs(dx))
+                value = np.uint8(acc / 16.0)
+                out[y, x] = value
+                hist[y, value] += 1
+
+        return out, hist
+
 class ImagePreprocessor:
     """Preprocessing avanzato immagini per migliorare OCR"""
-    
-    def __init__(self):
+
+    def __init__(self, use_gpu: bool = True):
         self.logger = logger.bind(component="ImagePreprocessor")
+
+        # Rileva il backend GPU una volta: CUDA se OpenCV è compilato
+        # con supporto e c'è un device, altrimenti OpenCL trasparente
+        # via UMat (T-API), altrimenti CPU puro
+        self._cuda = False
+        self._opencl = False
+        if use_gpu:
+            try:
+                self._cuda = cv2.cuda.getCudaEnabledDeviceCount() > 0
+            except Exception:
+                self._cuda = False
+            if not self._cuda:
+                try:
+                    self._opencl = cv2.ocl.haveOpenCL()
+                except Exception:
+                    self._opencl = False
+
+        if self._cuda or self._opencl:
+            self.logger.info(
+                "Preprocessing su GPU",
+                backend="cuda" if self._cuda else "opencl"
+            )
     
     def preprocess_invoice(
-        self, 
-        image_path: Path,
+        self,
+        image: Union[Path, np.ndarray],
         output_path: Optional[Path] = None
     ) -> np.ndarray:
         """
         Pipeline completa di preprocessing per fatture
-        
+
         Args:
-            image_path: Path all'immagine input
+            image: Path all'immagine input, oppure array già in memoria
+                   (es. pagina PDF rasterizzata, senza round-trip su disco)
             output_path: Path opzionale per salvare l'immagine processata
-            
+
         Returns:
             Immagine preprocessata come numpy array
         """
-        self.logger.info("Inizio preprocessing", image=str(image_path))
-        
-        # Carica immagine
-        img = cv2.imread(str(image_path))
-        if img is None:
-            raise ValueError(f"Impossibile caricare immagine: {image_path}")
+        if isinstance(image, np.ndarray):
+            self.logger.info("Inizio preprocessing", shape=image.shape)
+            img = image
+        else:
+            self.logger.info("Inizio preprocessing", image=str(image))
+            img = cv2.imread(str(image))
+            if img is None:
+                raise ValueError(f"Impossibile caricare immagine: {image}")
         
         # Pipeline di preprocessing
         img = self._resize_if_needed(img)
-        img = self._convert_to_grayscale(img)
-        img = self._denoise(img)
-        img = self._deskew(img)
-        img = self._binarize(img)
+        if njit is not None and not (self._cuda or self._opencl) and img.ndim == 3:
+            # Percorso fuso: un kernel Numba copre grayscale + denoise
+            # + istogramma, e la binarizzazione riusa l'istogramma
+            img = self._fused_gray_denoise_binarize(img)
+            img = self._deskew(img)
+        else:
+            img = self._convert_to_grayscale(img)
+
+            # Probe a basso costo su un sottocampione: i PDF digitali
+            # arrivano già nitidi e quasi binari, e pagano gli stadi
+            # più lenti senza alcun guadagno OCR. Deskew ha già la sua
+            # soglia interna sull'angolo stimato
+            probe = img[::4, ::4]
+            run_denoise = not (
+                probe.std() > 60
+                and cv2.Laplacian(probe, cv2.CV_64F).var() > 500
+            )
+            run_binarize = len(np.unique(img[::32, ::32])) > 3
+
+            if run_denoise:
+                img = self._denoise(img)
+            img = self._deskew(img)
+            if run_binarize:
+                img = self._binarize(img)
+
+            self.logger.debug(
+                "Stadi pipeline eseguiti",
+                denoise=run_denoise,
+                binarize=run_binarize
+            )
         img = self._remove_borders(img)
         img = self._enhance_contrast(img)
         
@@ -73,13 +167,99 @@ class ImagePreprocessor:
     
     def _denoise(self, img: np.ndarray) -> np.ndarray:
         """Riduzione rumore con filtro bilaterale"""
-        # Bilateral filter preserva i bordi
+        # Oltre ~4MP il bilaterale O(W·H·d²) domina la pipeline: filtra
+        # a mezza risoluzione e riscala (costo /4, qualità OCR
+        # equivalente sulle scansioni quasi binarie)
+        if img.size > 4_000_000:
+            height, width = img.shape[:2]
+            small = cv2.resize(
+                img, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA
+            )
+            small = self._bilateral(small)
+            return cv2.resize(
+                small, (width, height), interpolation=cv2.INTER_LINEAR
+            )
+
+        return self._bilateral(img)
+
+    def _bilateral(self, img: np.ndarray) -> np.ndarray:
+        """Filtro bilaterale sul backend disponibile"""
+        # Bilateral filter preserva i bordi; è lo stadio più costoso
+        # della pipeline, quindi il primo candidato per la GPU
+        if self._cuda:
+            gmat = cv2.cuda_GpuMat()
+            gmat.upload(img)
+            gmat = cv2.cuda.bilateralFilter(gmat, 9, 75, 75)
+            return gmat.download()
+
+        if self._opencl:
+            # T-API: stessa chiamata, esecuzione OpenCL trasparente
+            return cv2.bilateralFilter(cv2.UMat(img), 9, 75, 75).get()
+
         return cv2.bilateralFilter(img, 9, 75, 75)
     
+    def _fused_gray_denoise_binarize(self, img: np.ndarray) -> np.ndarray:
+        """Grayscale, denoise e binarizzazione con un solo passaggio DRAM
+
+        Il kernel fuso restituisce anche l'istogramma, da cui soglia di
+        Otsu e contrasto escono gratis: resta una sola passata finale di
+        threshold invece delle tre riletture del percorso a stadi. Il
+        denoise qui è l'approssimazione gaussiana del bilaterale, più
+        che sufficiente sulle scansioni quasi binarie.
+        """
+        blurred, hist_rows = _fused_gray_blur(img)
+        hist = hist_rows.sum(axis=0).astype(np.float64)
+
+        # Contrasto dal solo istogramma (stessa gate di _binarize)
+        total = hist.sum()
+        levels = np.arange(256, dtype=np.float64)
+        mean = (hist * levels).sum() / total
+        contrast = np.sqrt((hist * (levels - mean) ** 2).sum() / total)
+
+        if contrast > 50:
+            _, binary = cv2.threshold(
+                blurred, self._otsu_threshold(hist), 255, cv2.THRESH_BINARY
+            )
+            return binary
+
+        return cv2.adaptiveThreshold(
+            blurred, 255,
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY,
+            11, 2
+        )
+
+    @staticmethod
+    def _otsu_threshold(hist: np.ndarray) -> int:
+        """Soglia di Otsu da istogramma già calcolato"""
+        levels = np.arange(256, dtype=np.float64)
+        weight0 = np.cumsum(hist)
+        weight1 = weight0[-1] - weight0
+        cum_mean = np.cumsum(hist * levels)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean0 = cum_mean / weight0
+            mean1 = (cum_mean[-1] - cum_mean) / weight1
+            variance = weight0 * weight1 * (mean0 - mean1) ** 2
+
+        return int(np.nanargmax(variance))
+
     def _deskew(self, img: np.ndarray) -> np.ndarray:
         """Correzione inclinazione documento"""
-        # Trova angolo di rotazione
-        coords = np.column_stack(np.where(img > 0))
+        # Stima l'angolo su una copia sottocampionata 8x: l'angolo è
+        # invariante di scala, e cv2.findNonZero evita l'array (N, 2)
+        # di tutti i pixel di foreground a piena risoluzione (~80 MB di
+        # temporanei su una scansione 3000px). L'inversione seleziona i
+        # pixel di testo (scuri) invece dello sfondo
+        small = cv2.resize(
+            img, None, fx=0.125, fy=0.125, interpolation=cv2.INTER_AREA
+        )
+        coords = cv2.findNonZero(255 - small)
+
+        # Pagina bianca: nessun foreground, nessuna rotazione
+        if coords is None:
+            return img
+
         angle = cv2.minAreaRect(coords)[-1]
         
         # Correggi angolo
@@ -151,7 +331,17 @@ class ImagePreprocessor:
     
     def _enhance_contrast(self, img: np.ndarray) -> np.ndarray:
         """Migliora contrasto con CLAHE"""
+        if self._cuda:
+            gmat = cv2.cuda_GpuMat()
+            gmat.upload(img)
+            clahe = cv2.cuda.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            return clahe.apply(gmat, cv2.cuda_Stream.Null()).download()
+
         clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
+        if self._opencl:
+            return clahe.apply(cv2.UMat(img)).get()
+
         return clahe.apply(img)
     
     def detect_document_regions(self, img: np.ndarray) -> dict:
@@ -203,4 +393,4 @@ class ImagePreprocessor:
                 })
         
         return tables
-      /* Image Preprocessing con OpenCV */
+# Image Preprocessing con OpenCV
@@ -1,11 +1,52 @@
 # rpa/invoice_processor.py
+import asyncio
+import os
+
+# Tesseract single-thread: il suo OpenMP interno compete con il
+# parallelismo a processi e spreca core; un processo per fattura con
+# Tesseract mono-thread scala linearmente. Va impostato prima che
+# pytesseract/tesseract vengano caricati
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 from pathlib import Path
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Union
 import shutil
 from datetime import datetime
+import numpy as np
 import structlog
 from pdf2image import convert_from_path
 
+# PyMuPDF rasterizza in-process direttamente in un buffer numpy: niente
+# subprocess pdftoppm, niente PPM intermedio né round-trip PNG su disco
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
+# Cache risultati su disco: nei batch di produzione duplicati e retry
+# sono frequenti, e una fattura identica non deve rifare OCR né la
+# chiamata Azure. xxhash (SIMD) tiene l'hashing trascurabile rispetto
+# alla pipeline; hashlib è il fallback senza dipendenze
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+try:
+    import xxhash
+
+    def _content_hash(data: bytes) -> str:
+        return xxhash.xxh3_64(data).hexdigest()
+except ImportError:
+    import hashlib
+
+    def _content_hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+# Da incrementare quando cambia la semantica della pipeline (stadi di
+# preprocessing, prompt, regole di business): invalida la cache
+_PIPELINE_VERSION = '1'
+
 from preprocessing.image_processor import ImagePreprocessor
 from ocr.ocr_engine import InvoiceOCREngine
 from ai.azure_openai_validator import AzureOpenAIValidator, InvoiceData
@@ -13,16 +54,148 @@ from config import settings
 
 logger = structlog.get_logger()
 
+def _prepare_image(file_path: Path) -> Union[Path, np.ndarray]:
+    """Converte PDF in immagine (in memoria) se necessario"""
+
+    if file_path.suffix.lower() == '.pdf':
+        logger.debug("Conversione PDF in immagine")
+
+        if fitz is not None:
+            # Rasterizza la prima pagina in grigio direttamente nel
+            # buffer numpy che il preprocessing consumerà
+            doc = fitz.open(str(file_path))
+            try:
+                page = doc.load_page(0)
+                zoom = settings.OCR_DPI / 72
+                pix = page.get_pixmap(
+                    matrix=fitz.Matrix(zoom, zoom),
+                    colorspace=fitz.csGRAY
+                )
+                return np.frombuffer(
+                    pix.samples, dtype=np.uint8
+                ).reshape(pix.height, pix.width).copy()
+            finally:
+                doc.close()
+
+        # Fallback Poppler: grayscale e thread multipli, e l'immagine
+        # PIL passa a numpy senza essere riscritta come PNG
+        images = convert_from_path(
+            str(file_path),
+            dpi=settings.OCR_DPI,
+            first_page=1,
+            last_page=1,
+            grayscale=True,
+            thread_count=os.cpu_count() or 1
+        )
+
+        return np.asarray(images[0])
+
+    return file_path
+
+# Istanze warm per processo worker: create pigramente al primo task e
+# riusate per i successivi. Il validatore AI resta nel processo padre
+# (client di rete, non va serializzato verso i worker)
+_WORKER_PREPROCESSOR = None
+_WORKER_OCR_ENGINE = None
+
+def _worker_init() -> None:
+    """Inizializzazione processo worker
+
+    Con start method 'spawn' (Windows, macOS) l'ambiente del padre non è
+    garantito nel figlio: ribadisce il limite OpenMP di Tesseract. Le
+    istanze warm vengono costruite qui, una volta per worker, così il
+    caricamento del traineddata è ammortizzato su tutti i file del
+    batch e non pesa sul primo task.
+    """
+    global _WORKER_PREPROCESSOR, _WORKER_OCR_ENGINE
+
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+    _WORKER_PREPROCESSOR = ImagePreprocessor()
+    _WORKER_OCR_ENGINE = InvoiceOCREngine()
+
+def _extract_chunk(path_strs: List[str]) -> List[Dict]:
+    """
+    Elabora un chunk di fatture in un worker: preprocessing per file,
+    poi OCR dell'intero chunk in un'unica sessione Tesseract
+
+    Gli errori di preprocessing (file illeggibili, il caso comune)
+    restano isolati per file; il chunk passa all'OCR come lista.
+    """
+    global _WORKER_PREPROCESSOR, _WORKER_OCR_ENGINE
+
+    if _WORKER_OCR_ENGINE is None:
+        _WORKER_PREPROCESSOR = ImagePreprocessor()
+        _WORKER_OCR_ENGINE = InvoiceOCREngine()
+
+    results: List[Optional[Dict]] = []
+    images = []
+    prepared = []  # (indice risultato, path, istante di inizio)
+
+    for path_str in path_strs:
+        start_time = datetime.now()
+        try:
+            image_path = _prepare_image(Path(path_str))
+            images.append(
+                _WORKER_PREPROCESSOR.preprocess_invoice(image_path)
+            )
+            prepared.append((len(results), path_str, start_time))
+            results.append(None)
+        except Exception as e:
+            results.append({
+                'status': 'error',
+                'error': str(e),
+                'file_path': path_str
+            })
+
+    try:
+        ocr_results = _WORKER_OCR_ENGINE.extract_text_batch(images)
+
+        for (idx, path_str, start_time), ocr_result in zip(
+            prepared, ocr_results
+        ):
+            extracted_fields = _WORKER_OCR_ENGINE.extract_invoice_fields(
+                ocr_result.text,
+                ocr_result.words
+            )
+            results[idx] = {
+                'status': 'extracted',
+                'file_path': path_str,
+                'ocr_text': ocr_result.text,
+                'extracted_fields': {
+                    k: v.value for k, v in extracted_fields.items()
+                },
+                'ocr_confidence': ocr_result.confidence,
+                'ocr_time_seconds': (
+                    datetime.now() - start_time
+                ).total_seconds()
+            }
+    except Exception as e:
+        for idx, path_str, _ in prepared:
+            if results[idx] is None:
+                results[idx] = {
+                    'status': 'error',
+                    'error': str(e),
+                    'file_path': path_str
+                }
+
+    return results
+
 class InvoiceProcessorRPA:
     """Orchestratore principale pipeline RPA fatture"""
-    
+
     def __init__(self):
         self.logger = logger.bind(component="RPAProcessor")
-        
+
         self.preprocessor = ImagePreprocessor()
         self.ocr_engine = InvoiceOCREngine()
         self.ai_validator = AzureOpenAIValidator()
-        
+
+        self.cache = (
+            diskcache.Cache(str(settings.CACHE_DIR))
+            if diskcache is not None else None
+        )
+
         # Stats
         self.stats = {
             'processed': 0,
@@ -30,76 +203,105 @@ class InvoiceProcessorRPA:
             'failed': 0,
             'manual_review': 0
         }
-    
+
     def process_invoice(
-        self, 
+        self,
         file_path: Path,
-        save_debug_images: bool = True
+        save_debug_images: bool = False
     ) -> Dict:
         """
         Pipeline completa elaborazione fattura
-        
+
         Args:
             file_path: Path al file PDF o immagine
-            save_debug_images: Se salvare immagini intermedie
-            
+            save_debug_images: Se salvare immagini intermedie (encode
+                PNG + scrittura disco; attivabile globalmente con
+                SAVE_DEBUG_IMAGES)
+
         Returns:
             Dizionario con risultati elaborazione
         """
         self.logger.info("Inizio elaborazione fattura", file=str(file_path))
         start_time = datetime.now()
-        
+
+        # Lookup in cache per contenuto: stesso file (anche rinominato)
+        # già elaborato -> risultato immediato, niente OCR né Azure
+        cache_key = None
+        if self.cache is not None:
+            content = file_path.read_bytes()
+            cache_key = f"{_content_hash(content)}:{_PIPELINE_VERSION}"
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.logger.info("Fattura in cache", file=str(file_path))
+                result = dict(cached)
+                result['file_path'] = str(file_path)
+
+                # Anche i hit contano nel report: la fattura viene
+                # comunque archiviata e salvata a valle
+                self.stats['processed'] += 1
+                if result.get('requires_manual_review'):
+                    self.stats['manual_review'] += 1
+                else:
+                    self.stats['successful'] += 1
+
+                return result
+
         try:
             # Step 1: Conversione PDF → Immagine (se necessario)
             image_path = self._prepare_image(file_path)
-            
-            # Step 2: Preprocessing immagine
-            if save_debug_images:
+
+            # Step 2: Preprocessing immagine (tutto in memoria; il dump
+            # su disco è solo un ausilio di debug)
+            if save_debug_images or settings.SAVE_DEBUG_IMAGES:
                 preprocessed_path = settings.TEMP_DIR / f"{file_path.stem}_preprocessed.png"
             else:
                 preprocessed_path = None
-            
+
             preprocessed_img = self.preprocessor.preprocess_invoice(
                 image_path,
                 preprocessed_path
             )
-            
+
             # Step 3: Estrazione testo OCR
             ocr_result = self.ocr_engine.extract_text(preprocessed_img)
-            
+
             # Step 4: Estrazione campi strutturati
             extracted_fields = self.ocr_engine.extract_invoice_fields(
                 ocr_result.text,
-                ocr_result.word_data
+                ocr_result.words
             )
-            
+
             # Convert InvoiceField to dict for AI
             fields_dict = {
                 k: v.value for k, v in extracted_fields.items()
             }
-            
+
             # Step 5: Validazione e strutturazione con AI
-            validated_invoice = self.ai_validator.validate_and_structure_invoice(
-                ocr_text=ocr_result.text,
-                extracted_fields=fields_dict,
-                ocr_confidence=ocr_result.confidence
+            validated_invoice = asyncio.run(
+                self.ai_validator.validate_and_structure_invoice(
+                    ocr_text=ocr_result.text,
+                    extracted_fields=fields_dict,
+                    ocr_confidence=ocr_result.confidence
+                )
             )
-            
+
             # Step 6: Semantic similarity check
-            similarity = self.ai_validator.semantic_similarity_check(
-                ocr_result.text,
-                validated_invoice
+            similarity = asyncio.run(
+                self.ai_validator.semantic_similarity_check(
+                    ocr_result.text,
+                    validated_invoice
+                )
             )
-            
+
             if similarity < 0.6:
                 validated_invoice.requires_manual_review = True
                 validated_invoice.validation_notes.append(
                     f"Bassa coerenza semantica: {similarity:.2f}"
                 )
-            
+
             # Step 7: Salva risultati
             processing_time = (datetime.now() - start_time).total_seconds()
-            
+
             result = {
                 'status': 'success',
                 'invoice_data': validated_invoice.model_dump(),
@@ -109,13 +311,16 @@ class InvoiceProcessorRPA:
                 'requires_manual_review': validated_invoice.requires_manual_review,
                 'file_path': str(file_path)
             }
-            
+
             self.stats['processed'] += 1
             if validated_invoice.requires_manual_review:
                 self.stats['manual_review'] += 1
             else:
                 self.stats['successful'] += 1
-            
+
+            if cache_key is not None:
+                self.cache[cache_key] = result
+
             self.logger.info(
                 "Fattura elaborata con successo",
                 invoice_number=validated_invoice.invoice_number,
@@ -123,9 +328,9 @@ class InvoiceProcessorRPA:
                 processing_time=f"{processing_time:.2f}s",
                 requires_review=validated_invoice.requires_manual_review
             )
-            
+
             return result
-            
+
         except Exception as e:
             self.logger.error(
                 "Errore elaborazione fattura",
@@ -133,79 +338,206 @@ class InvoiceProcessorRPA:
                 error=str(e),
                 exc_info=True
             )
-            
+
             self.stats['processed'] += 1
             self.stats['failed'] += 1
-            
+
             return {
                 'status': 'error',
                 'error': str(e),
                 'file_path': str(file_path)
             }
-    
-    def _prepare_image(self, file_path: Path) -> Path:
-        """Converte PDF in immagine se necessario"""
-        
-        if file_path.suffix.lower() == '.pdf':
-            self.logger.debug("Conversione PDF in immagine")
-            
-            # Converti prima pagina PDF
-            images = convert_from_path(
-                str(file_path),
-                dpi=settings.OCR_DPI,
-                first_page=1,
-                last_page=1
-            )
-            
-            image_path = settings.TEMP_DIR / f"{file_path.stem}.png"
-            images[0].save(image_path, 'PNG')
-            
-            return image_path
-        
-        return file_path
-    
+
+    def _prepare_image(self, file_path: Path) -> Union[Path, np.ndarray]:
+        """Converte PDF in immagine (in memoria) se necessario"""
+        return _prepare_image(file_path)
+
     def process_batch(
-        self, 
+        self,
         files: List[Path],
-        max_workers: int = 3
+        max_workers: Optional[int] = None
     ) -> List[Dict]:
-        """Elaborazione batch con parallelizzazione"""
-        from concurrent.futures import ThreadPoolExecutor, as_completed
-        
+        """
+        Elaborazione batch con parallelizzazione
+
+        Preprocessing e OCR (CPU-bound) girano su un pool di processi,
+        uno per core; le validazioni AI (network-bound) partono appena
+        il chunk relativo è estratto, sovrapposte al lavoro CPU dei
+        chunk successivi: il tempo totale tende al massimo tra pipeline
+        CPU e pipeline di rete, non alla loro somma.
+        """
         self.logger.info("Inizio elaborazione batch", count=len(files))
-        
-        results = []
-        
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_file = {
-                executor.submit(self.process_invoice, f): f 
-                for f in files
-            }
-            
-            for future in as_completed(future_to_file):
-                file = future_to_file[future]
-                try:
-                    result = future.result()
-                    results.append(result)
-                except Exception as e:
-                    self.logger.error(
-                        "Errore elaborazione batch",
-                        file=str(file),
-                        error=str(e)
-                    )
-                    results.append({
-                        'status': 'error',
-                        'error': str(e),
-                        'file_path': str(file)
-                    })
-        
+
+        results = asyncio.run(self._process_batch_async(files, max_workers))
+
         self.logger.info(
             "Batch completato",
             **self.stats
         )
-        
+
+        return results
+
+    async def _process_batch_async(
+        self,
+        files: List[Path],
+        max_workers: Optional[int] = None
+    ) -> List[Dict]:
+        """Pipeline batch: estrazione su pool processi, AI in overlap"""
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Lookup in cache per contenuto prima del dispatch al pool: nei
+        # batch di produzione duplicati e retry sono frequenti, e un
+        # file già elaborato non deve occupare un worker né spendere
+        # chiamate Azure
+        results = []
+        pending = []
+        pending_keys = {}
+
+        if self.cache is not None:
+            for file_path in files:
+                try:
+                    cache_key = (
+                        f"{_content_hash(file_path.read_bytes())}"
+                        f":{_PIPELINE_VERSION}"
+                    )
+                except OSError:
+                    pending.append(file_path)
+                    continue
+
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    self.logger.info("Fattura in cache", file=str(file_path))
+                    hit = dict(cached)
+                    hit['file_path'] = str(file_path)
+                    results.append(hit)
+
+                    # Anche i hit contano nel report: la fattura viene
+                    # comunque archiviata e salvata a valle
+                    self.stats['processed'] += 1
+                    if hit.get('requires_manual_review'):
+                        self.stats['manual_review'] += 1
+                    else:
+                        self.stats['successful'] += 1
+                else:
+                    pending_keys[str(file_path)] = cache_key
+                    pending.append(file_path)
+        else:
+            pending = list(files)
+
+        if not pending:
+            return results
+
+        if max_workers is None:
+            max_workers = min(len(pending), os.cpu_count() or 1)
+
+        # Chunk espliciti: ogni worker riceve un blocco di file, lo
+        # preprocessa e lo OCRizza in un'unica sessione Tesseract
+        # (meno round-trip IPC e stato recognizer riusato nel chunk)
+        chunks = [
+            [str(f) for f in pending[i:i + 4]]
+            for i in range(0, len(pending), 4)
+        ]
+
+        loop = asyncio.get_running_loop()
+
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_worker_init
+        ) as executor:
+            cpu_futures = [
+                loop.run_in_executor(executor, _extract_chunk, chunk)
+                for chunk in chunks
+            ]
+
+            # La validazione di un chunk parte appena la sua estrazione
+            # termina, mentre i worker macinano i chunk rimanenti; la
+            # concorrenza verso Azure resta governata dal semaforo e
+            # dal rate limiter del validatore
+            validation_tasks = []
+            for future in asyncio.as_completed(cpu_futures):
+                extractions = await future
+                validation_tasks.append(asyncio.ensure_future(
+                    self._validate_extractions(extractions)
+                ))
+
+            for task in validation_tasks:
+                for result in await task:
+                    results.append(result)
+                    cache_key = pending_keys.get(result.get('file_path'))
+                    if (cache_key is not None
+                            and result.get('status') == 'success'):
+                        self.cache[cache_key] = result
+
         return results
-    
+
+    async def _validate_extractions(self, extractions: List[Dict]) -> List[Dict]:
+        """Valida con AI i risultati OCR prodotti dai worker"""
+
+        results = []
+        pending = []
+        jobs = []
+
+        for extraction in extractions:
+            if extraction['status'] == 'error':
+                self.stats['processed'] += 1
+                self.stats['failed'] += 1
+                results.append(extraction)
+                continue
+
+            pending.append(extraction)
+            jobs.append({
+                'ocr_text': extraction['ocr_text'],
+                'extracted_fields': extraction['extracted_fields'],
+                'ocr_confidence': extraction['ocr_confidence']
+            })
+
+        validated = await self.ai_validator.validate_batch(jobs)
+
+        for extraction, outcome in zip(pending, validated):
+            self.stats['processed'] += 1
+
+            if isinstance(outcome, Exception):
+                self.logger.error(
+                    "Errore validazione AI",
+                    file=extraction['file_path'],
+                    error=str(outcome)
+                )
+                self.stats['failed'] += 1
+                results.append({
+                    'status': 'error',
+                    'error': str(outcome),
+                    'file_path': extraction['file_path']
+                })
+                continue
+
+            similarity = await self.ai_validator.semantic_similarity_check(
+                extraction['ocr_text'],
+                outcome
+            )
+
+            if similarity < 0.6:
+                outcome.requires_manual_review = True
+                outcome.validation_notes.append(
+                    f"Bassa coerenza semantica: {similarity:.2f}"
+                )
+
+            if outcome.requires_manual_review:
+                self.stats['manual_review'] += 1
+            else:
+                self.stats['successful'] += 1
+
+            results.append({
+                'status': 'success',
+                'invoice_data': outcome.model_dump(),
+                'ocr_confidence': extraction['ocr_confidence'],
+                'semantic_similarity': similarity,
+                'processing_time_seconds': extraction['ocr_time_seconds'],
+                'requires_manual_review': outcome.requires_manual_review,
+                'file_path': extraction['file_path']
+            })
+
+        return results
+
     def get_stats(self) -> Dict:
         """Ritorna statistiche elaborazione"""
         if self.stats['processed'] > 0:
@@ -214,10 +546,10 @@ class InvoiceProcessorRPA:
         else:
             success_rate = 0
             review_rate = 0
-        
+
         return {
             **self.stats,
             'success_rate': f"{success_rate:.1f}%",
             'manual_review_rate': f"{review_rate:.1f}%"
         }
-      //* Orchestrazione Pipeline RPA */
+# Orchestrazione Pipeline RPA